@@ -0,0 +1,166 @@
+"""Records the rows that the cleaners drop or change.
+
+Within an AuditLog the console shows only how many rows each cleaning step
+drops or changes. The rows themselves are handed to a logging QueueHandler, and
+a thread in the background writes them alongside the report (e.g.
+formatted_x.audit.csv). The queue is bounded, so a cleaner that gets far ahead
+of the writer waits for it rather than holding every row in memory.
+
+'Audit' sets the format of the file ('csv', 'jsonl', or 'none' for none at
+all), 'Audit Detail' whether each row is written in full ('rows') or only by
+its position in the input ('index'), and 'Audit Row Cap' the most rows written
+for each cleaning step.
+"""
+
+# Python stdlib imports
+from __future__ import unicode_literals
+from logging.handlers import QueueHandler, QueueListener
+import io
+import logging
+import os
+import queue
+import threading
+
+# package imports
+from common import *
+
+# the most batches of rows waiting to be written
+MAX_QUEUED_BATCHES = 64
+
+def log_rows(rows):
+    """Log each of the rows in a dataframe as a single batched message"""
+    logging.info('\n'.join([ '\t{:>2} {}'.format(index, printable(row))
+                              for index, row in zip(rows.index, rows.itertuples(index = False)) ]))
+
+# a helper class that waits for room on a bounded queue, rather than dropping the record
+class BlockingQueueHandler(QueueHandler):
+
+    def enqueue(self, record):
+        self.queue.put(record)
+
+# a helper class that writes each batch of rows to the file of the audit log it was recorded in
+class AuditFileHandler(logging.Handler):
+
+    def emit(self, record):
+        try:
+            record.audit_log.write(record.rows, record.cleaner, record.description)
+        except Exception:
+            self.handleError(record)
+
+audit_queue = queue.Queue(maxsize = MAX_QUEUED_BATCHES)
+audit_logger = logging.getLogger('audit')
+audit_logger.propagate = False
+audit_logger.setLevel(logging.INFO)
+audit_logger.addHandler(BlockingQueueHandler(audit_queue))
+
+class AuditLog:
+    """ The file that the rows the cleaners drop or change are written to,
+        while cleaning an input within a `with` block. The writing thread runs
+        while any AuditLog is open in the process, and the last to close waits
+        for it to write the rows still queued.
+    """
+
+    FORMATS = ['csv', 'jsonl', 'none']
+
+    lock = threading.Lock()
+    current = threading.local()
+    listener, listener_pid, users = None, None, 0
+
+    def __init__(self, path, audit_format = 'csv', detail = 'rows', row_cap = None, dry_run = False):
+        """ :param path: the file to write to, or None to only log how many rows are dropped or changed
+            :param row_cap: the most rows written for each cleaning step, or None for all of them
+            :param dry_run: whether the rows are only those that would be dropped or changed
+        """
+        self.path = path if audit_format != 'none' else None
+        self.audit_format = audit_format
+        self.detail = detail
+        self.row_cap = row_cap
+        self.dry_run = dry_run
+        self.queued = {}     # the number of rows queued for each cleaning step, by cleaner and description
+        self.columns = None  # the columns of the file, once the first rows are written
+
+    def __enter__(self):
+        if self.path and os.path.isfile(self.path):
+            os.remove(self.path)
+
+        with AuditLog.lock:
+            # the writing thread isn't carried over into a forked worker process
+            if AuditLog.listener_pid != os.getpid():
+                AuditLog.listener, AuditLog.users = None, 0
+            if AuditLog.listener is None:
+                AuditLog.listener = QueueListener(audit_queue, AuditFileHandler())
+                AuditLog.listener.start()
+                AuditLog.listener_pid = os.getpid()
+            AuditLog.users += 1
+
+        self.previous = getattr(AuditLog.current, 'audit_log', None)
+        AuditLog.current.audit_log = self
+        return self
+
+    def __exit__(self, *exc_info):
+        AuditLog.current.audit_log = self.previous
+        with AuditLog.lock:
+            AuditLog.users -= 1
+            if AuditLog.users == 0:
+                AuditLog.listener.stop()
+                AuditLog.listener = None
+
+    def record(self, rows, cleaner, description):
+        """ Queues the `rows` that `cleaner` drops or changes to be written, up
+            to the row cap, and returns how many were queued. A cleaner used
+            more than once (e.g. a filter on 'Total' and another on 'TEST') is
+            capped separately for each `description`.
+        """
+        if not self.path:
+            return 0
+
+        step = (cleaner, description)
+        queued = self.queued.get(step, 0)
+        if self.row_cap is not None:
+            rows = rows.iloc[:max(0, self.row_cap - queued)]
+        if not len(rows):
+            return 0
+
+        self.queued[step] = queued + len(rows)
+        audit_logger.info(description, extra = {'audit_log': self, 'rows': rows, 'cleaner': cleaner, 'description': description})
+        return len(rows)
+
+    def write(self, rows, cleaner, description):
+        """ Appends the `rows` to the file; runs on the writing thread """
+        # later rows are written with the columns of the first, which (as the filters run first) has them all
+        if self.columns is None:
+            self.columns = [] if self.detail == 'index' else list(rows.columns)
+
+        table = rows.reindex(columns = self.columns)
+        table.insert(0, 'row', rows.index)
+        table.insert(0, 'where', description)
+        table.insert(0, 'cleaner', cleaner)
+
+        if self.audit_format == 'jsonl':
+            with io.open(self.path, 'a') as audit_file:
+                # some versions of pandas end the lines with a newline, and some don't
+                lines = table.to_json(orient = 'records', lines = True, date_format = 'iso', default_handler = str)
+                audit_file.write(lines.rstrip('\n') + '\n')
+        else:
+            with io.open(self.path, 'a', newline = '') as audit_file:
+                table.to_csv(audit_file, header = audit_file.tell() == 0, index = False)
+
+def audit_rows(rows, cleaner, change, description):
+    """ Logs the `rows` that `cleaner` is about to drop or change: within an
+        AuditLog, how many there are, with the rows themselves written to its
+        file; otherwise each of the rows.
+
+        :param change: what is done to the rows, e.g. 'Removing'
+        :param description: which rows they are, e.g. '"Line Item" contains "TEST"'
+    """
+    audit_log = getattr(AuditLog.current, 'audit_log', None)
+    if audit_log is None:
+        logging.info('{} the following row(s) where {}:'.format(change, description))
+        log_rows(rows)
+        return
+
+    queued = audit_log.record(rows, cleaner, description)
+    if audit_log.dry_run:
+        change = 'Would be ' + change[0].lower() + change[1:]
+    logging.info('{} {} row(s) where {}{}.'.format(change, len(rows), description,
+        '' if not queued else ' (see "{}"{})'.format(audit_log.path, '' if queued == len(rows) else ', which holds the first {}'.format(queued))))
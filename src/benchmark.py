@@ -0,0 +1,242 @@
+"""Benchmarks for the report formatting stages"""
+
+# Python stdlib imports
+from __future__ import division, unicode_literals
+from collections import defaultdict
+from timeit import default_timer
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+# package imports
+from reporter import *
+from synthetic import *
+
+# third party imports
+import openpyxl
+
+def build_workbook(column_count):
+    """ Returns a WrappedWorkbook holding the minimal set of tags that the
+        formatting stages look for, laid out in the same way as the template.
+    """
+    workbook = openpyxl.Workbook()
+    worksheet = workbook.active
+    worksheet['A1'] = '<icon>'
+    worksheet['B5'] = '<header_start>'
+    worksheet['A6'] = '<order_id>'
+    worksheet['B6'] = '<data_start>'
+    worksheet.cell(row = 6, column = column_count + 1).value = '<data_end>'
+    return WrappedWorkbook(workbook = workbook)
+
+def synthetic_report(rows, group_size = 3):
+    """ Returns a cleaned report of `rows` line items, grouped into sets of
+        `group_size` line items that share their dates and line item id.
+    """
+    config = load_config()
+    export = synthetic_export(rows, group_sizes = (group_size,), total_row = False)
+    return reduce(lambda df, cleaner: cleaner(df), build_cleaners(config), export)
+
+def time_write_totals(rows, group_size = 3, repeat = 3):
+    """ Returns the fastest time (in seconds) taken by write_totals on a
+        freshly written report of `rows` line items.
+    """
+    df = synthetic_report(rows, group_size)
+    timings = []
+    for _ in range(repeat):
+        wrapped_workbook = write_data(df, build_workbook(len(df.columns)))
+        timings.append(timeit.timeit(lambda: write_totals(wrapped_workbook), number = 1))
+    return min(timings)
+
+def benchmark_write_totals(sizes = (1000, 2000, 4000, 8000)):
+    """ Times write_totals across increasing report sizes; the time per row
+        should stay roughly flat if the stage scales linearly.
+    """
+    log_divider(symbol = '*')
+    logging.info('Benchmarking write_totals...')
+    log_divider(symbol = '*')
+    logging.info('{:>10s} {:>12s} {:>16s}'.format('Rows', 'Seconds', 'Microseconds/row'))
+
+    results = []
+    for rows in sizes:
+        seconds = time_write_totals(rows)
+        results.append((rows, seconds))
+        logging.info('{:>10d} {:>12.4f} {:>16.2f}'.format(rows, seconds, 1e6 * seconds / rows))
+
+    (first_rows, first_seconds), (last_rows, last_seconds) = results[0], results[-1]
+    logging.info('Growth: {:.1f}x the rows took {:.1f}x the time.'.format(last_rows / first_rows,
+                                                                         last_seconds / first_seconds))
+    return results
+
+def save_template(path, column_count):
+    """ Saves a minimal template holding just the tags, for when the real one is not to hand """
+    build_workbook(column_count).workbook.save(path)
+    return path
+
+def time_stages(export, template_path, output_mode = 'workbook', repeat = 3, work_dir = None):
+    """ Formats the `export` `repeat` times and returns the fastest time (in
+        seconds) taken by each stage of the pipeline, as recorded by its
+        metrics, along with grouping the line items and the full run.
+
+        :rtype: dict
+    """
+    config = load_config()
+    work_dir = work_dir or tempfile.mkdtemp()
+    input_path = write_export(export, os.path.join(work_dir, 'benchmark.xlsx'))
+    metrics_path = os.path.join(work_dir, 'formatted_benchmark.metrics.json')
+    if output_mode == 'sheets':
+        # the report is a sheet of a workbook shared by the batch, with the metrics of each sheet (less the save) beside it
+        metrics_path = os.path.join(work_dir, 'formatted_reports.benchmark.metrics.json')
+    inputs = dict(config, **{'Outputs Directory': work_dir,
+                             'Template': template_path,
+                             'Output Mode': output_mode,
+                             'Metrics': 'json',
+                             'Trace Memory': False})
+    template_layout = load_template(template_path)
+    validators = [partial(validate_column_names, required_columns = config['Required Columns'])]
+    cleaners = build_cleaners(config)
+    reader = build_chunk_reader(config) if output_mode == 'chunked' else build_reader(config)
+
+    timings = defaultdict(list)
+    for _ in range(repeat):
+        start = default_timer()
+        format_reports([input_path], inputs = inputs,
+                                     reader = reader,
+                                     validators = validators,
+                                     cleaners = cleaners,
+                                     columns_to_merge = config['Columns To Merge'],
+                                     template_layout = template_layout)
+        timings['total'].append(default_timer() - start)
+
+        # stages that run more than once (e.g. a cleaner on two columns) are added together
+        stage_seconds = defaultdict(float)
+        with open(metrics_path) as metrics_file:
+            for stage in json.load(metrics_file)['stages']:
+                stage_seconds[stage['stage']] += stage['seconds']
+        for stage, seconds in stage_seconds.items():
+            timings[stage].append(seconds)
+
+    df_clean = reduce(lambda df, cleaner: cleaner(df), cleaners, export)
+    timings['report_groups'] = [ timeit.timeit(lambda: list(report_groups(df_clean)), number = 1) for _ in range(repeat) ]
+
+    return dict((stage, min(seconds)) for stage, seconds in timings.items())
+
+def find_regressions(results, baseline, threshold, min_seconds = 0.05):
+    """ Returns (case, stage, seconds, baseline seconds) for each stage that
+        took more than `threshold` (a fraction) longer than in the baseline.
+        Stages quicker than `min_seconds` are too noisy to compare.
+    """
+    regressions = []
+    for case, stages in sorted(results.items()):
+        for stage, seconds in sorted(stages.items()):
+            before = baseline.get(case, {}).get(stage)
+            if before is not None and seconds > max(before, min_seconds) * (1 + threshold):
+                regressions.append((case, stage, seconds, before))
+    return regressions
+
+def benchmark_stages(sizes, template_path, output_mode = 'workbook', repeat = 3, baseline = None, **export_options):
+    """ Times each stage of the pipeline across synthetic exports of
+        increasing size, logging each against the baseline if given.
+
+        :param export_options: passed on to synthetic_export
+    """
+    log_divider(symbol = '*')
+    logging.info('Benchmarking the {} pipeline against "{}"...'.format(output_mode, template_path))
+    log_divider(symbol = '*')
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        if not os.path.isfile(template_path):
+            logging.warning('Template "{}" not found; using a minimal template instead.'.format(template_path))
+            template_path = save_template(os.path.join(work_dir, 'template.xlsx'), len(load_config()['Report Columns']))
+
+        results = {}
+        for rows in sizes:
+            case = '{} rows'.format(rows)
+            export = synthetic_export(rows, **export_options)
+
+            # the cleaners and formatters log every row they touch
+            level = logging.getLogger().level
+            logging.getLogger().setLevel(logging.WARNING)
+            try:
+                results[case] = time_stages(export, template_path, output_mode, repeat, work_dir)
+            finally:
+                logging.getLogger().setLevel(level)
+
+            logging.info(case)
+            logging.info('{:>40s} {:>12s} {:>12s} {:>10s}'.format('Stage', 'Seconds', 'Baseline', 'Change'))
+            for stage, seconds in sorted(results[case].items(), key = lambda item: -item[1]):
+                before = (baseline or {}).get(case, {}).get(stage)
+                logging.info('{:>40s} {:>12.4f} {:>12s} {:>10s}'.format(stage, seconds,
+                             '{:.4f}'.format(before) if before else '-',
+                             '{:+.0%}'.format(seconds / before - 1) if before else '-'))
+            log_divider()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors = True)
+
+    return results
+
+def parse_arguments(argv = None):
+    parser = argparse.ArgumentParser(description = 'Benchmarks the report formatter on synthetic DFP exports.')
+    parser.add_argument('--rows', type = int, nargs = '+', default = [1000, 5000, 20000],
+                        help = 'the sizes of export to benchmark')
+    parser.add_argument('--group-sizes', type = int, nargs = '+', default = [1, 1, 1, 2, 3, 5],
+                        help = 'the sizes of line item group to draw from')
+    parser.add_argument('--native-share', type = float, default = 0.2,
+                        help = 'the fraction of line items with Native creatives')
+    parser.add_argument('--test-rows', type = int, default = 10,
+                        help = 'the number of TEST line items to add')
+    parser.add_argument('--no-total-row', dest = 'total_row', action = 'store_false',
+                        help = 'leave out the Total row that DFP ends an export with')
+    parser.add_argument('--template', default = DEFAULT_CONFIG['Template'],
+                        help = 'the template workbook')
+    parser.add_argument('--mode', choices = ['workbook', 'streaming', 'chunked', 'sheets'], default = 'workbook',
+                        help = 'the output engine')
+    parser.add_argument('--repeat', type = int, default = 3,
+                        help = 'the number of runs to take the fastest of')
+    parser.add_argument('--baseline', help = 'a JSON file of earlier results to compare against')
+    parser.add_argument('--threshold', type = float, default = 0.2,
+                        help = 'the fraction slower than the baseline that fails the benchmark')
+    parser.add_argument('--save', help = 'the JSON file to save these results to, as a new baseline')
+    parser.add_argument('--write-totals', action = 'store_true',
+                        help = 'only check that write_totals scales linearly, over the --rows sizes')
+    return parser.parse_args(argv)
+
+def main(argv = None):
+    arguments = parse_arguments(argv)
+
+    if arguments.write_totals:
+        benchmark_write_totals(sizes = arguments.rows)
+        return 0
+
+    baseline = None
+    if arguments.baseline:
+        with open(arguments.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    results = benchmark_stages(arguments.rows, arguments.template,
+                               output_mode = arguments.mode,
+                               repeat = arguments.repeat,
+                               baseline = baseline,
+                               group_sizes = arguments.group_sizes,
+                               native_share = arguments.native_share,
+                               test_rows = arguments.test_rows,
+                               total_row = arguments.total_row)
+
+    if arguments.save:
+        with open(arguments.save, 'w') as results_file:
+            json.dump(results, results_file, indent = 2, sort_keys = True)
+        logging.info('Saved results to "{}".'.format(arguments.save))
+
+    regressions = find_regressions(results, baseline or {}, arguments.threshold)
+    for case, stage, seconds, before in regressions:
+        logging.error('Regression: {} took {:.4f}s on {}, against {:.4f}s in the baseline.'.format(stage, seconds, case, before))
+
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
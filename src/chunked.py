@@ -0,0 +1,209 @@
+"""Formats reports too large to hold in memory, working through the input a
+chunk of rows at a time.
+
+Each chunk is read, cleaned and sorted into the order the report is written
+in, then spilled to disk as a sorted run. The runs are merged a block of rows
+at a time, and each group of line items is streamed to the output as soon as
+it is complete (see streamer.stream_rows). The chunks, and the blocks held
+during the merge, are sized from the memory budget, so memory use is bounded
+by the budget rather than by the size of the input.
+
+The cleaners see one chunk at a time, so a row filter is applied even if it
+drops every row of a chunk.
+"""
+
+# Python stdlib imports
+from __future__ import unicode_literals
+from itertools import groupby
+import heapq
+import logging
+import os
+import pickle
+import shutil
+import tempfile
+
+# third party imports
+import numpy
+
+# package imports
+from plan import *
+from readers import rows_within_budget
+from reporter import *
+from streamer import stream_rows
+
+# the most sorted runs merged at once; any more are merged in rounds
+MAX_MERGE_RUNS = 32
+
+def sort_value(value):
+    """ Returns a key that sorts blanks after every other value, as pandas does """
+    if value is None or (isinstance(value, float) and numpy.isnan(value)):
+        return (1, '')
+    return (0, value)
+
+def sorted_rows(df, first_row):
+    """ Yields the rows of a cleaned chunk as (key, values), in the order that
+        group_line_items would write them: by group, then line item and
+        creative size. The key ends with each row's position in the input, so
+        that rows which tie are kept in their input order.
+    """
+    group_ids = get_group_ids(df)
+    keys = zip(group_ids.values,
+               df['Line Item'].map(sort_value).values,
+               df['Creative Size'].map(sort_value).values,
+               range(first_row, first_row + len(df)))
+    return sorted(zip(keys, report_values(df).tolist()), key = lambda item: item[0])
+
+def write_run(items, path, block_rows):
+    """ Writes the sorted (key, values) `items` to `path` as pickled blocks of `block_rows` """
+    with open(path, 'wb') as run_file:
+        block = []
+        for item in items:
+            block.append(item)
+            if len(block) == block_rows:
+                pickle.dump(block, run_file, pickle.HIGHEST_PROTOCOL)
+                block = []
+        if block:
+            pickle.dump(block, run_file, pickle.HIGHEST_PROTOCOL)
+    return path
+
+def read_run(path):
+    """ Yields the (key, values) items of a sorted run, reading a block at a time """
+    with open(path, 'rb') as run_file:
+        while True:
+            try:
+                block = pickle.load(run_file)
+            except EOFError:
+                return
+            for item in block:
+                yield item
+
+def merge_runs(paths, spill_directory, block_rows):
+    """ Yields the items of all the sorted runs at `paths` in order, first
+        merging them into fewer, longer runs if there are too many to hold a
+        block of each in memory at once.
+    """
+    paths = list(paths)
+    rounds = 0
+    while len(paths) > MAX_MERGE_RUNS:
+        merging, paths = paths[:MAX_MERGE_RUNS], paths[MAX_MERGE_RUNS:]
+        merged_path = os.path.join(spill_directory, 'merged-{}.pickle'.format(rounds))
+        rounds += 1
+        paths.append(write_run(heapq.merge(*[ read_run(path) for path in merging ]), merged_path, block_rows))
+        for path in merging:
+            os.remove(path)
+
+    return heapq.merge(*[ read_run(path) for path in paths ])
+
+# a helper class to hold what was learnt about a report while it was spilled to disk
+class SpilledReport:
+
+    def __init__(self, block_rows, headers = None, order_id = None, runs = None, chunks = 0, rows_in = 0, rows_out = 0):
+        self.block_rows = block_rows
+        self.headers = headers
+        self.order_id = order_id
+        self.runs = runs if runs is not None else []
+        self.chunks = chunks
+        self.rows_in = rows_in
+        self.rows_out = rows_out
+        self.totals = {'Ad server impressions': 0, 'Ad server clicks': 0}
+
+def spill_report(chunks, validators, cleaners, spill_directory, memory_budget):
+    """ Validates, cleans and sorts each chunk of the input, writing each to
+        `spill_directory` as a sorted run.
+
+        :param memory_budget: the memory (in MB) that the runs may take up
+            when they are merged, a block of each at a time
+
+        :return: the spilled report, or None if the input is invalid
+        :rtype: SpilledReport
+    """
+    plan = CleanerPlan(cleaners)
+    if not plan.is_planned:
+        logging.warning('Not every cleaner can be planned; any row filters among them may be ignored for some chunks.')
+
+    report = None
+    for chunk in chunks:
+        if report is None:
+            if not all([ validator(chunk) for validator in validators ]):
+                return None
+            # a block of every run being merged must fit within the budget together
+            report = SpilledReport(block_rows = max(100, rows_within_budget(memory_budget, len(chunk.columns)) // MAX_MERGE_RUNS))
+            if len(chunk):
+                report.order_id = extract_order_id(chunk['Line Item'].iloc[0])
+
+        first_row = report.rows_in
+        report.chunks += 1
+        report.rows_in += len(chunk)
+        df_clean, _ = plan.execute(chunk, strict_filters = True)
+
+        report.headers = list(df_clean.columns.values)
+        if not len(df_clean):
+            continue
+
+        report.rows_out += len(df_clean)
+        for column in report.totals:
+            report.totals[column] += df_clean[column].sum()
+
+        path = os.path.join(spill_directory, 'run-{}.pickle'.format(len(report.runs)))
+        report.runs.append(write_run(sorted_rows(df_clean, first_row), path, report.block_rows))
+        logging.debug('Spilled rows {} to {} as "{}".'.format(first_row, report.rows_in - 1, path))
+
+    if report is not None and report.rows_in and not report.rows_out:
+        logging.error('All rows have been filtered out.')
+    return report
+
+def stream_spilled_report(report, spill_directory, **kwargs):
+    """ Merges the sorted runs of `report` and streams the report to the output
+
+        :param kwargs: passed on to streamer.stream_rows
+    """
+    items = merge_runs(report.runs, spill_directory, report.block_rows)
+    groups = ( [ values for _, values in group ] for _, group in groupby(items, key = lambda item: item[0][0]) )
+    return stream_rows(report.headers, report_rows_for_groups(report.headers, groups), **kwargs)
+
+def format_report_in_chunks(input_path, inputs, reader, validators, cleaners, columns_to_merge, template_layout):
+    """ Formats a single input report as reporter.format_report does, reading
+        and cleaning it a chunk at a time and streaming the output.
+
+        :param reader: reads the input report as chunks of rows (see readers.read_report_chunks)
+    """
+    profiler = Profiler(trace_memory = inputs['Trace Memory'])
+    output_path = get_output_path(input_path, inputs['Outputs Directory'])
+
+    spill_directory = tempfile.mkdtemp(prefix = 'reporter-')
+
+    try:
+        logging.info('\nCleaning data for "{}" in chunks...'.format(input_path))
+        with build_audit_log(input_path, inputs):
+            report = profiler.run('spill_report', partial(spill_report, validators = validators,
+                                                                        cleaners = cleaners,
+                                                                        spill_directory = spill_directory,
+                                                                        memory_budget = inputs['Memory Budget']), reader(input_path))
+        if report is None:
+            logging.error('Input report "{}" is invalid; report will be skipped.'.format(input_path))
+            return None
+
+        formula_values = profiler.run('stream_report', partial(stream_spilled_report, spill_directory = spill_directory,
+                                                                                      layout = template_layout,
+                                                                                      output_path = output_path,
+                                                                                      image_path = inputs['Icon'],
+                                                                                      order_id = report.order_id,
+                                                                                      columns_to_merge = columns_to_merge), report)
+    finally:
+        shutil.rmtree(spill_directory, ignore_errors = True)
+
+    logging.info('Workbook "{}" formatting complete!\n'.format(output_path))
+
+    summary = [('Input Report', input_path),
+               ('Report Name', os.path.basename(output_path)),
+               ('Order ID', report.order_id),
+               ('Total Ad server impressions', report.totals['Ad server impressions']),
+               ('Total Ad server clicks', report.totals['Ad server clicks']),
+               ('Saved Totals', 'match' if formula_values.check(report.totals, output_path) else 'DO NOT MATCH'),
+               ('Chunks', report.chunks)]
+
+    if inputs['Metrics'] in ['json', 'csv']:
+        metrics_path = os.path.splitext(output_path)[0] + '.metrics.' + inputs['Metrics']
+        summary.append(('Metrics', profiler.write(metrics_path, inputs['Metrics'])))
+
+    return summary + profiler.summary()
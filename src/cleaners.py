@@ -1,40 +1,55 @@
 from __future__ import unicode_literals
 
-from functools import reduce
+import datetime
 import logging
 import numpy as np
 import re
 
+from audit import *
 from common import *
 
-def drop_row_with_value_in_column(df, column_name, value, exact_match):
-
-    if exact_match:
-        filtered = df.groupby(df[column_name] == value)
-    else:
-        filtered = df.groupby(df[column_name].str.contains(value))
-
-    if False not in filtered.groups:
-        logging.error('All rows have been filtered out where "{}" {} value "{}". Ignoring cleaning step.'.format(
-            column_name,
-            'equals' if exact_match else 'contains',
-            value))
+def column_mask(df, equals = {}, not_equals = {}):
+    """Return a boolean mask of the rows where each column in `equals` holds the
+    given value and each column in `not_equals` doesn't.
+    """
+    mask = np.ones(len(df), dtype = bool)
+    for column_name, value in equals.items():
+        mask &= (df[column_name] == value).values
+    for column_name, value in not_equals.items():
+        mask &= (df[column_name] != value).values
+    return mask
+
+def drop_rows_matching(df, matches, description, cleaner = 'drop_rows_matching'):
+    """Drop the rows where `matches` is True. Rows where `matches` is missing
+    (e.g. a substring search on a blank cell) are neither kept nor logged.
+    """
+    keep_rows, drop_rows = matches.eq(False), matches.eq(True)
+
+    if not keep_rows.any():
+        logging.error('All rows have been filtered out where {}. Ignoring cleaning step.'.format(description))
         return df
 
-    if True not in filtered.groups:
+    if not drop_rows.any():
         return df
 
-    keep_rows, drop_rows = filtered.get_group(False), filtered.get_group(True)
+    audit_rows(df[drop_rows], cleaner, 'Removing', description)
+
+    return df[keep_rows]
 
-    logging.info('Removing the following row(s) where "{}" {} "{}":'.format(
-        column_name,
-        'equals' if exact_match else 'contains',
-        value))
+def value_in_column(df, column_name, value, exact_match):
+    """Return a mask of the rows where `column_name` equals (or contains) `value`,
+    along with a description of the test for logging.
+    """
+    if exact_match:
+        matches = df[column_name] == value
+    else:
+        matches = df[column_name].str.contains(value)
 
-    for index, row in drop_rows.iterrows():
-        logging.info('\t{:>2} {}'.format(index, printable(row)))
+    return matches, '"{}" {} "{}"'.format(column_name, 'equals' if exact_match else 'contains', value)
 
-    return keep_rows
+def drop_row_with_value_in_column(df, column_name, value, exact_match):
+    matches, description = value_in_column(df, column_name, value, exact_match)
+    return drop_rows_matching(df, matches, description, cleaner = 'drop_row_with_value_in_column')
 
 def replace_column_value(df, column_name, pattern, replacement):
     logging.debug('Replacing "{}" with "{}" in column "{}"'.format(pattern, replacement, column_name))
@@ -46,32 +61,50 @@ def replace_column_extract(df, column_name, extract_value_from_row):
     df[column_name] = df.apply (lambda row: extract_value_from_row(row), axis=1)
     return df
 
+def replace_column_where(df, column_name, replacement_column, equals = {}, not_equals = {}):
+    """Replace the values in `column_name` with those in `replacement_column` on
+    the rows selected by `equals` and `not_equals` (see column_mask).
+    """
+    logging.debug('Replacing "{}" with "{}" where {} and not {}.'.format(column_name, replacement_column, equals, not_equals))
+    df[column_name] = np.where(column_mask(df, equals, not_equals), df[replacement_column], df[column_name])
+    return df
+
 def drop_columns_not_required(df, required_columns):
 
     actual_columns = list(df.columns.values)
     ignored_columns = [ column for column in actual_columns if column not in required_columns ]
 
     logging.debug('Removing columns: "{0}" column.'.format(', '.join(ignored_columns)))
-    return reduce(lambda df, column: df.drop(column, 1), ignored_columns, df)
+    return df.drop(ignored_columns, axis = 1)
 
 def replace_value_below_threshold_with_nan(df, column_name, threshold):
 
-    singular_goal_quantities = df[df[column_name] <= threshold]
-    if not singular_goal_quantities.empty:
-        logging.info('Overwriting {} values under {} with "N/A"'.format(column_name, threshold))
-        for index, row in singular_goal_quantities.iterrows():
-            logging.info('\t{:>2} {}'.format(index, printable(row)))
+    below_threshold = df[column_name] <= threshold
+    if below_threshold.any():
+        audit_rows(df[below_threshold], 'replace_value_below_threshold_with_nan',
+                   'Overwriting {} with "N/A" in'.format(column_name), '{} is under {}'.format(column_name, threshold))
 
-    df.loc[df[column_name] <= threshold, column_name] = np.nan
+    df.loc[below_threshold, column_name] = np.nan
     return df
 
+def as_date(value):
+    return value.date() if isinstance(value, datetime.datetime) else value
+
 def replace_datetime_with_date(df, column_name):
     logging.debug('Converting {} from datetime to date.'.format(column_name))
-    df[column_name] = df[column_name].dt.date if 'Unlimited' not in df[column_name].values else df[column_name]
+    # a column holding 'Unlimited' is converted value by value, so that each date is a date
+    # whether or not the rest of the column (or, in chunked mode, of the chunk) holds one
+    if df[column_name].dtype.kind == 'M':
+        df[column_name] = df[column_name].dt.date
+    else:
+        df[column_name] = df[column_name].map(as_date)
     return df
 
 def reorder_columns(df, ordered_columns):
     logging.debug('Reordering dataframe to have columns: {}.'.format(','.join(ordered_columns)))
+    if df.columns.tolist() == list(ordered_columns):
+        return df
+
     original_columns = set(df.columns.tolist())
     updated_columns = set(ordered_columns)
     if original_columns == updated_columns:
@@ -80,3 +113,30 @@ def reorder_columns(df, ordered_columns):
         logging.error('Columns provided for reordering do not match those already present in the dataframe.')
         logging.error('Columns in one and not the other: {}.'.format(','.join(original_columns ^ updated_columns)))
         return df
+
+# the cleaners that can be named in a config file
+CLEANERS = dict((cleaner.__name__, cleaner) for cleaner in [drop_row_with_value_in_column,
+                                                             replace_column_value,
+                                                             replace_column_where,
+                                                             drop_columns_not_required,
+                                                             replace_value_below_threshold_with_nan,
+                                                             replace_datetime_with_date,
+                                                             reorder_columns])
+
+# the columns each cleaner reads and writes, given its arguments, so that a
+# chain of cleaners can be planned (see plan.CleanerPlan)
+CLEANER_COLUMNS = {
+    'drop_row_with_value_in_column': lambda column_name, **_: ([column_name], []),
+    'replace_column_value': lambda column_name, **_: ([column_name], [column_name]),
+    'replace_column_where': lambda column_name, replacement_column, equals = {}, not_equals = {}, **_:
+        ([column_name, replacement_column] + list(equals) + list(not_equals), [column_name]),
+    'drop_columns_not_required': lambda required_columns, **_: (list(required_columns), []),
+    'replace_value_below_threshold_with_nan': lambda column_name, **_: ([column_name], [column_name]),
+    'replace_datetime_with_date': lambda column_name, **_: ([column_name], [column_name]),
+    'reorder_columns': lambda ordered_columns, **_: (list(ordered_columns), [])
+}
+
+# the cleaners that only drop rows, and the tests that pick the rows they drop
+ROW_FILTERS = {
+    'drop_row_with_value_in_column': value_in_column
+}
@@ -1,6 +1,7 @@
 from __future__ import unicode_literals
 from builtins import input
 
+import hashlib
 import logging
 import os
 import sys
@@ -18,6 +19,14 @@ def bind(x, f):
 ############## Input & Output ##############
 ############################################
 
+def file_hash(path, chunk_size = 1 << 20):
+    """Return the SHA-1 of the contents of the file at `path`"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
 def printable(items, is_data_row = True):
     return ('|' if is_data_row else '') + ', '.join([ str(c) for c in items ])
 
@@ -71,7 +80,8 @@ def query_yes_no(question, default="yes"):
 
 def offer_clean_exit(output_path):
     logging.error('Skipping report creation for report "{}".'.format(output_path))
-    if query_yes_no('* Output file "{}" is being abandoned - want me to delete it?'.format(output_path)):
+    if os.path.isfile(output_path) and \
+       query_yes_no('* Output file "{}" is being abandoned - want me to delete it?'.format(output_path)):
         logging.info('Deleting file {}...'.format(output_path))
         os.remove(output_path)
     return
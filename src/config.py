@@ -0,0 +1,204 @@
+"""Settings for a run of the report formatter, with defaults that a JSON or
+YAML config file can override.
+
+Cleaners are listed by name, each with the keyword arguments it is called
+with, e.g. in JSON:
+
+    "Cleaners": [
+        {"cleaner": "replace_value_below_threshold_with_nan",
+         "column_name": "Goal quantity",
+         "threshold": 5000}
+    ]
+"""
+
+# Python stdlib imports
+from __future__ import unicode_literals
+from copy import deepcopy
+from functools import partial
+import json
+import logging
+import multiprocessing
+import os
+
+# package imports
+from cleaners import *
+from readers import read_report, read_report_chunks, rows_within_budget
+from validators import ReportSchema
+
+DEFAULT_CONFIG = {
+    'Sheet Name'        : 'Report data',
+    'Inputs Directory'  : 'inputs',
+    'Outputs Directory' : 'outputs',
+    'Template'          : os.path.join('assets','template.xlsx'),
+    'Icon'              : os.path.join('assets','icon.png'),
+    'Output Mode'       : 'workbook',
+
+    # write a report for each order (ORD-...) found in an input, rather than one for the whole input
+    'Split Orders'      : False,
+    'Input Engine'      : 'auto',
+    'Workers'           : multiprocessing.cpu_count(),
+
+    # when reports are formatted one at a time, the number of inputs read ahead of (and outputs
+    # saved behind) the report being formatted, so that slow reads and writes overlap; 0 turns this off
+    'Prefetch'          : 2,
+    'Cache Directory'   : '.cache',
+
+    # with --watch, how often (in seconds) the inputs directory is checked, and how long an input must go
+    # unchanged before it is formatted, so that one still being written or copied is left until it is done
+    'Watch Interval'    : 2,
+    'Settle Seconds'    : 5,
+
+    # in 'chunked' output mode, the memory (in MB) that a report is worked on within
+    'Memory Budget'     : 512,
+
+    # per-stage timings are written alongside each report as 'json', 'csv' or 'none';
+    # tracing memory as well makes the run several times slower
+    'Metrics'           : 'json',
+    'Trace Memory'      : False,
+
+    # the rows each cleaner drops or changes are written alongside each report as 'csv', 'jsonl' or 'none',
+    # and the console shows only how many there are; 'Audit Detail' is 'rows' to write each row in full or
+    # 'index' for only its position in the input, and 'Audit Row Cap' the most rows written for each cleaner
+    'Audit'             : 'csv',
+    'Audit Detail'      : 'rows',
+    'Audit Row Cap'     : 10000,
+
+    # the columns the input must have, in the order they appear
+    'Required Columns'  : ['Line Item',
+                           'Creative',
+                           'Delivery Indicator',
+                           'Line item start date',
+                           'Line item end date',
+                           'Goal quantity',
+                           'Creative Size',
+                           'DAP Native Format',
+                           'Ad server impressions',
+                           'Ad server clicks',
+                           'Ad server CTR'],
+
+    # the input columns that hold dates, and those to read as text rather than inferring their type
+    'Date Columns'      : ['Line item start date',
+                           'Line item end date'],
+
+    'Text Columns'      : ['Line Item',
+                           'Creative',
+                           'Delivery Indicator',
+                           'Creative Size',
+                           'DAP Native Format'],
+
+    # the input columns that must hold numbers (or be blank); an input is checked for these, and for
+    # the dates in the date columns, from its first few rows before the whole of it is read
+    'Number Columns'    : ['Goal quantity',
+                           'Ad server impressions',
+                           'Ad server clicks',
+                           'Ad server CTR'],
+
+    # the columns of the formatted report, in the order they are written
+    'Report Columns'    : ['Line Item',
+                           'Line item start date',
+                           'Line item end date',
+                           'Goal quantity',
+                           'Creative Size',
+                           'Delivery Indicator',
+                           'Ad server impressions',
+                           'Ad server clicks',
+                           'Ad server CTR'],
+
+    'Columns To Merge'  : ['Delivery Indicator',
+                           'Line item start date',
+                           'Line item end date',
+                           'Goal quantity'],
+
+    'Cleaners'          : [{'cleaner': 'drop_row_with_value_in_column',
+                            'column_name': 'Line Item', 'value': 'Total', 'exact_match': True},
+                           {'cleaner': 'drop_row_with_value_in_column',
+                            'column_name': 'Line Item', 'value': 'TEST', 'exact_match': False},
+                           {'cleaner': 'replace_value_below_threshold_with_nan',
+                            'column_name': 'Goal quantity', 'threshold': 1000},
+                           {'cleaner': 'replace_column_value',
+                            'column_name': 'Creative Size', 'pattern': '1 x 1', 'replacement': 'pageskin'},
+                           {'cleaner': 'replace_column_where',
+                            'column_name': 'Creative Size', 'replacement_column': 'DAP Native Format',
+                            'equals': {'Creative Size': 'Native'}, 'not_equals': {'DAP Native Format': '-'}},
+                           {'cleaner': 'drop_columns_not_required'},
+                           {'cleaner': 'replace_datetime_with_date', 'column_name': 'Line item start date'},
+                           {'cleaner': 'replace_datetime_with_date', 'column_name': 'Line item end date'},
+                           {'cleaner': 'reorder_columns'}]
+}
+
+# the settings that change what a formatted report looks like
+OUTPUT_SETTINGS = ['Sheet Name', 'Output Mode', 'Split Orders', 'Input Engine', 'Required Columns', 'Date Columns',
+                   'Number Columns', 'Text Columns', 'Report Columns', 'Columns To Merge', 'Cleaners']
+
+def read_config_file(config_path):
+    with open(config_path) as config_file:
+        if os.path.splitext(config_path)[1].lower() in ('.yaml', '.yml'):
+            try:
+                import yaml
+            except ImportError:
+                raise ValueError('Reading "{}" requires PyYAML; install it or use a JSON config.'.format(config_path))
+            return yaml.safe_load(config_file) or {}
+        return json.load(config_file)
+
+def load_config(config_path = None):
+    """ Returns the default config, updated with the settings in the JSON or
+        YAML file at `config_path` (if given).
+
+        :rtype: dict
+    """
+    config = deepcopy(DEFAULT_CONFIG)
+    if config_path:
+        logging.debug('Reading config from "{}"...'.format(config_path))
+        overrides = read_config_file(config_path)
+        unknown = [ key for key in overrides if key not in DEFAULT_CONFIG ]
+        if unknown:
+            raise ValueError('Unknown setting(s) in "{}": {}'.format(config_path, ', '.join(unknown)))
+        config.update(overrides)
+    return config
+
+def build_cleaners(config):
+    """ Returns the cleaners listed in the config, with their arguments bound.
+        The column pruning and reordering cleaners default to the config's
+        'Report Columns'.
+    """
+    cleaners = []
+    for spec in config['Cleaners']:
+        kwargs = dict(spec)
+        name = kwargs.pop('cleaner', None)
+        if name not in CLEANERS:
+            raise ValueError('Unknown cleaner "{}"; expected one of: {}'.format(name, ', '.join(sorted(CLEANERS))))
+
+        if name == 'drop_columns_not_required':
+            kwargs.setdefault('required_columns', config['Report Columns'])
+        elif name == 'reorder_columns':
+            kwargs.setdefault('ordered_columns', config['Report Columns'])
+
+        cleaners.append(partial(CLEANERS[name], **kwargs))
+    return cleaners
+
+def build_schema(config):
+    """ Returns the schema that input reports are checked against before they are read """
+    column_types = dict((column, 'number') for column in config['Number Columns'])
+    column_types.update((column, 'date') for column in config['Date Columns'])
+    return ReportSchema(config['Required Columns'], column_types)
+
+def build_reader(config):
+    """ Returns the reader for input reports, as set up by the config """
+    return partial(read_report, sheet_name = config['Sheet Name'],
+                                columns = config['Required Columns'],
+                                date_columns = config['Date Columns'],
+                                text_columns = config['Text Columns'],
+                                engine = config['Input Engine'],
+                                schema = build_schema(config))
+
+def build_chunk_reader(config):
+    """ Returns the reader for input reports in chunked output mode, which
+        reads them in chunks sized to fit the config's 'Memory Budget'.
+    """
+    return partial(read_report_chunks, sheet_name = config['Sheet Name'],
+                                       columns = config['Required Columns'],
+                                       date_columns = config['Date Columns'],
+                                       text_columns = config['Text Columns'],
+                                       engine = config['Input Engine'],
+                                       chunk_rows = rows_within_budget(config['Memory Budget'], len(config['Required Columns'])),
+                                       schema = build_schema(config))
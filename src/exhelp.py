@@ -3,16 +3,262 @@
 # Python stdlib imports
 from __future__ import unicode_literals
 from collections import defaultdict
-from itertools import product
+from copy import copy, deepcopy
+from itertools import islice, product
 import logging
+import numbers
+import os
 import re
+import warnings
+import zipfile
 
 # package imports
 from common import *
+from past.builtins import basestring
 
 # openpyxl imports
+import openpyxl
+from openpyxl.drawing.spreadsheet_drawing import SpreadsheetDrawing
 from openpyxl.styles import Font
 from openpyxl.styles.borders import Border, Side
+from openpyxl.styles.named_styles import NamedStyleList
+from openpyxl.utils import get_column_letter
+from openpyxl.utils.indexed_list import IndexedList
+
+def load_workbook(path):
+    # openpyxl warns about each feature of the template it doesn't support; the warnings are
+    # ignored only while it loads, so that the other threads' logging carries on meanwhile
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return openpyxl.load_workbook(filename = path)
+
+# the version of openpyxl (as pinned in requirements.txt) whose workbook and worksheet
+# internals workbook_from_template copies; with any other, the template is loaded afresh
+TEMPLATE_COPY_VERSION = '2.4.0'
+
+def can_copy_template():
+    return openpyxl.__version__ == TEMPLATE_COPY_VERSION
+
+# the parts of a worksheet that are copied from a template, besides its cells, dimensions and merged cells
+TEMPLATE_SHEET_PARTS = ['sheet_format', 'sheet_properties', 'sheet_state', 'views', 'print_options', 'page_margins',
+                        'page_breaks', 'protection', 'auto_filter', 'sort_state', 'data_validations',
+                        'conditional_formatting', '_print_rows', '_print_cols', '_print_area']
+
+def workbook_from_template(template):
+    """ Returns a new workbook holding a copy of the `template` worksheet, as
+        loading the template again would, so that a template loaded once can be
+        shared by every report. The template workbook's style tables are copied
+        first, so that each cell keeps the indices of its styles as they are.
+    """
+    source = template.parent
+    workbook = openpyxl.Workbook()
+    workbook._fonts = IndexedList(source._fonts)
+    workbook._fills = IndexedList(source._fills)
+    workbook._borders = IndexedList(source._borders)
+    workbook._alignments = IndexedList(source._alignments)
+    workbook._protections = IndexedList(source._protections)
+    workbook._number_formats = IndexedList(source._number_formats)
+    workbook._cell_styles = IndexedList(source._cell_styles)
+    workbook._named_styles = NamedStyleList(source._named_styles)
+    workbook._differential_styles.styles = list(source._differential_styles.styles)
+    workbook._colors = source._colors
+    workbook.loaded_theme = source.loaded_theme
+    workbook.properties = copy(source.properties)
+
+    worksheet = workbook.active
+    worksheet.title = template.title
+    for (row, column), cell in template._cells.items():
+        copied = worksheet.cell(row = row, column = column)
+        copied._value = cell._value
+        copied.data_type = cell.data_type
+        if cell.has_style:
+            copied._style = copy(cell._style)
+
+    for dimensions, copied_dimensions in [(template.row_dimensions, worksheet.row_dimensions),
+                                          (template.column_dimensions, worksheet.column_dimensions)]:
+        for key, dimension in dimensions.items():
+            copied_dimensions[key] = copy(dimension)
+            copied_dimensions[key].worksheet = worksheet
+
+    worksheet._merged_cells = list(template._merged_cells)
+    for part in TEMPLATE_SHEET_PARTS:
+        setattr(worksheet, part, deepcopy(getattr(template, part)))
+    worksheet.page_setup = copy(template.page_setup)
+    worksheet.page_setup._parent = worksheet
+    return workbook
+
+def keep_sheet_on_disk(worksheet):
+    """ Saving a write-only worksheet reads the whole of the temporary file it
+        was written to back into memory. This makes it save an empty sheet
+        instead, leaving the file for add_merged_cells to copy into the saved
+        workbook in chunks, and returns the file's path.
+    """
+    def write_empty_sheet():
+        worksheet._drawing = SpreadsheetDrawing()
+        worksheet._drawing.charts = worksheet._charts
+        worksheet._drawing.images = worksheet._images
+        worksheet.close()
+        return ''
+
+    worksheet._write = write_empty_sheet
+    return worksheet.filename
+
+def write_merged_cells(output, ranges, batch_size = 10000):
+    """ Writes a mergeCells element for `ranges` (if there are any) to the
+        binary file `output`, a batch of ranges at a time.
+    """
+    ranges = iter(ranges)
+    batch = list(islice(ranges, batch_size))
+    if not batch:
+        return
+
+    output.write(b'<mergeCells>')
+    while batch:
+        output.write(''.join([ '<mergeCell ref="{}"/>'.format(r) for r in batch ]).encode('utf-8'))
+        batch = list(islice(ranges, batch_size))
+    output.write(b'</mergeCells>')
+
+# a formula cell as openpyxl writes it, with an empty value
+FORMULA_CELL = re.compile(br'<c r="([A-Z]+[0-9]+)"([^>]*)><f>([^<]*)</f>(?:<v ?/>|<v></v>)</c>')
+
+def fill_formula_values_in(chunks, values):
+    """ Yields the chunks of worksheet XML with the cached value of each
+        formula cell whose coordinate is in `values` filled in, so that the
+        value can be read without the workbook being recalculated.
+
+        :param values: the value of each formula, keyed by coordinate (e.g. 'H15')
+        :type values: dict
+    """
+    def fill(match):
+        value = values.get(match.group(1).decode('ascii'))
+        if value is None:
+            return match.group(0)
+        return b''.join([b'<c r="', match.group(1), b'"', match.group(2), b'><f>', match.group(3), b'</f><v>',
+                         (str(value) if isinstance(value, numbers.Integral) else repr(value)).encode('ascii'), b'</v></c>'])
+
+    # a cell may be split across chunks, so each is filled up to the end of its last whole cell
+    tail = b''
+    for chunk in chunks:
+        chunk = tail + chunk
+        end = chunk.rfind(b'</c>') + len(b'</c>') if b'</c>' in chunk else 0
+        chunk, tail = chunk[:end], chunk[end:]
+        yield FORMULA_CELL.sub(fill, chunk)
+    yield tail
+
+def fill_formula_values(path, values_by_sheet):
+    """ Fills in the cached values of formulas in the worksheets of a saved
+        workbook (see fill_formula_values_in), copying each worksheet across
+        in chunks.
+
+        :param values_by_sheet: the values for each worksheet, keyed by its
+            part name (e.g. 'xl/worksheets/sheet1.xml')
+    """
+    rewritten_path = path + '.tmp'
+    with zipfile.ZipFile(path) as source, \
+         zipfile.ZipFile(rewritten_path, 'w', zipfile.ZIP_DEFLATED, allowZip64 = True) as target:
+        for item in source.infolist():
+            if not values_by_sheet.get(item.filename):
+                target.writestr(item, source.read(item.filename))
+                continue
+
+            with source.open(item) as sheet, target.open(item, 'w', force_zip64 = True) as output:
+                for chunk in fill_formula_values_in(iter(lambda: sheet.read(1 << 20), b''), values_by_sheet[item.filename]):
+                    output.write(chunk)
+
+    os.remove(path)
+    os.rename(rewritten_path, path)
+
+def add_merged_cells(path, ranges, sheet_name = 'xl/worksheets/sheet1.xml', sheet_file = None, formula_values = None):
+    """ Adds merged cell ranges to a worksheet of a saved workbook, for
+        worksheets written in write-only mode (which cannot merge cells).
+        The worksheet XML is copied across in chunks so that it is never held
+        in memory in full.
+
+        :param ranges: the ranges to merge, e.g. ['A1:A10', 'B2:C2'], which
+            may be produced as they are written
+        :type ranges: Iterable[str]
+
+        :param sheet_file: a file holding the worksheet XML, to copy in place
+            of the saved worksheet (see keep_sheet_on_disk); it is removed
+
+        :param formula_values: the cached values of formulas to fill in as
+            the worksheet is copied (see fill_formula_values_in)
+    """
+    rewritten_path = path + '.tmp'
+    with zipfile.ZipFile(path) as source, \
+         zipfile.ZipFile(rewritten_path, 'w', zipfile.ZIP_DEFLATED, allowZip64 = True) as target:
+        for item in source.infolist():
+            if item.filename != sheet_name:
+                target.writestr(item, source.read(item.filename))
+                continue
+
+            # mergeCells must directly follow the sheetData element
+            marker, tail = b'</sheetData>', b''
+            with (open(sheet_file, 'rb') if sheet_file else source.open(item)) as sheet, \
+                 target.open(item, 'w', force_zip64 = True) as output:
+                chunks = iter(lambda: sheet.read(1 << 20), b'')
+                if formula_values:
+                    chunks = fill_formula_values_in(chunks, formula_values)
+                for chunk in chunks:
+                    chunk = tail + chunk
+                    if marker and marker in chunk:
+                        head, chunk = chunk.split(marker, 1)
+                        output.write(head + marker)
+                        write_merged_cells(output, ranges)
+                        marker = None
+                    tail = chunk[-len(marker):] if marker else b''
+                    output.write(chunk[:len(chunk) - len(tail)])
+                output.write(tail)
+
+    os.remove(path)
+    os.rename(rewritten_path, path)
+    if sheet_file:
+        os.remove(sheet_file)
+
+INVALID_TITLE_CHARACTERS = re.compile(r'[\\*?:/\[\]]')
+
+def copy_template_sheet(workbook, template, title):
+    """ Returns a copy of the `template` worksheet within the same workbook,
+        titled `title` (made valid as a sheet title). openpyxl copies the
+        cells, dimensions and merged cells; the page setup, margins and views
+        are copied here too. Images are not copied.
+    """
+    title = INVALID_TITLE_CHARACTERS.sub('_', title)[:31]
+
+    # a title already taken is numbered, keeping within the 31 characters allowed
+    unique_title, number = title, 1
+    while unique_title in workbook.sheetnames:
+        unique_title = '{}{}'.format(title[:31 - len(str(number))], number)
+        number += 1
+
+    worksheet = workbook.copy_worksheet(template)
+    worksheet.title = unique_title
+
+    worksheet.page_setup = copy(template.page_setup)
+    worksheet.page_setup._parent = worksheet
+    worksheet.print_options = copy(template.print_options)
+    worksheet.page_margins = copy(template.page_margins)
+    worksheet.views = deepcopy(template.views)
+    return worksheet
+
+def merge_ranges(worksheet, ranges):
+    """ Merges each of the `ranges`, as worksheet.merge_cells does, but
+        registers them all at once: merge_cells searches the sheet's merged
+        ranges for each new one, which is quadratic over a large report.
+
+        :param ranges: (first_row, first_column, last_row, last_column) of each range
+    """
+    merged = set(worksheet._merged_cells)
+    for first_row, first_column, last_row, last_column in ranges:
+        range_string = '{}{}:{}{}'.format(get_column_letter(first_column), first_row, get_column_letter(last_column), last_row)
+        if range_string in merged:
+            continue
+        merged.add(range_string)
+        worksheet._merged_cells.append(range_string)
+
+        # all but the top-left cell are removed
+        for position in islice(product(range(first_row, last_row + 1), range(first_column, last_column + 1)), 1, None):
+            worksheet._cells.pop(position, None)
 
 def get_cells_by_regex(worksheet, pattern):
     matcher = re.compile(pattern)
@@ -22,6 +268,90 @@ def get_cell_by_regex(worksheet, pattern):
     all_matches = get_cells_by_regex(worksheet, pattern)
     return (all_matches[0] if all_matches else None)
 
+class TagIndex:
+    """ An index of the `<tag>` cells in a worksheet, built in a single pass
+        over the cells and kept up to date as values are written through it.
+
+        Tags are keyed by their full label (e.g. `<data_start>`) and by their
+        kind, the leading word of the label (e.g. `subtotal` for
+        `<subtotal_3_Ad server clicks>`, `total` for `<total_Ad server CTR>`).
+    """
+
+    TAG_PATTERN = re.compile(r'^<(?P<kind>[^\W_]+)[\w\s]*>$')
+
+    def __init__(self):
+        self._by_tag = defaultdict(dict)
+        self._by_kind = defaultdict(dict)
+
+    @staticmethod
+    def from_worksheet(worksheet):
+        tags = TagIndex()
+        for cell in worksheet.get_cell_collection():
+            tags.add(cell)
+        return tags
+
+    @staticmethod
+    def from_positions(worksheet, positions):
+        """ Builds the index from the positions of the tags found earlier (see
+            layout.TemplateLayout), without scanning the rest of the worksheet.
+
+            :param positions: lists of (row, column) keyed by tag
+        """
+        tags = TagIndex()
+        for cells in positions.values():
+            for row, column in cells:
+                tags.add(worksheet.cell(row = row, column = column))
+        return tags
+
+    @staticmethod
+    def kind_of(value):
+        """ Returns the kind of tag held in `value`, or None if it isn't a tag """
+        if not isinstance(value, basestring) or not value.startswith('<'):
+            return None
+        matches = TagIndex.TAG_PATTERN.match(value)
+        return matches.group('kind') if matches else None
+
+    def add(self, cell):
+        kind = TagIndex.kind_of(cell.value)
+        if kind is not None:
+            key = (cell.row, cell.col_idx)
+            self._by_tag[cell.value][key] = cell
+            self._by_kind[kind][key] = cell
+
+    def discard(self, cell):
+        kind = TagIndex.kind_of(cell.value)
+        if kind is not None:
+            key = (cell.row, cell.col_idx)
+            self._by_tag[cell.value].pop(key, None)
+            self._by_kind[kind].pop(key, None)
+
+    def set_value(self, cell, value):
+        """ Writes `value` to `cell`, updating the index if either the old or
+            the new value is a tag.
+        """
+        self.discard(cell)
+        cell.value = value
+        self.add(cell)
+
+    def positions(self):
+        """ Returns the (row, column) of every cell holding a tag """
+        return set([ key for cells in self._by_kind.values() for key in cells ])
+
+    def cells(self, tag):
+        """ Returns all the cells holding `tag`, in row then column order """
+        return [ self._by_tag[tag][key] for key in sorted(self._by_tag[tag]) ]
+
+    def cell(self, tag):
+        cells = self.cells(tag)
+        return (cells[0] if cells else None)
+
+    def cells_of_kind(self, kind):
+        """ Returns all the cells holding a tag of `kind`, in row then column order """
+        return [ self._by_kind[kind][key] for key in sorted(self._by_kind[kind]) ]
+
+    def all_cells(self):
+        return [ cell for kind in list(self._by_kind) for cell in self.cells_of_kind(kind) ]
+
 def range_size(first_cell, last_cell):
     """ Returns the height and width of the range `start_cell`:`end_cell`
 
@@ -61,10 +391,67 @@ def get_add_formula(cells):
     """
     return '={}'.format('+'.join([ cell.coordinate for cell in cells ]))
 
+def get_column_subtotal_formula(column, first_row, last_row):
+    """ Returns a formula summing a column between first_row and last_row
+        (inclusive) that ignores any SUBTOTAL formulas within that range, so
+        that nested subtotals are never counted twice.
+
+        :param column: the letter of the column holding the values
+        :type column: str
+    """
+    return '=SUBTOTAL(9,{0}{1}:{0}{2})'.format(column, first_row, last_row)
+
 ##########################
 ######Style Helpers#######
 ##########################
 
+class StyleCache:
+    """ Registers each distinct combination of styles with the workbook once
+        and shares it with every cell that uses it. Assigning a font, border
+        etc. to a cell hashes every property of that style to look it up in the
+        workbook, which dominates the time taken to style large reports.
+    """
+
+    def __init__(self):
+        self._styles = {}
+
+    def apply(self, cell, key, **styles):
+        """ Styles `cell` with `styles` (font = ..., border = ..., etc.), which
+            must always be the same for the same `key`.
+        """
+        style = self._styles.get(key)
+        if style is None:
+            for name, value in styles.items():
+                setattr(cell, name, value)
+            self._styles[key] = copy(cell._style)
+        else:
+            cell._style = copy(style)
+        return cell
+
+class BorderCache:
+    """ Hands out one shared Border per combination of bordered edges """
+
+    def __init__(self, style = 'medium'):
+        self.style = style
+        self.borders = {}
+
+    def get(self, left, right, top, bottom):
+        key = (left, right, top, bottom)
+        if key not in self.borders:
+            side = Side(style = self.style)
+            self.borders[key] = Border(left = side if left else Side(None),
+                                       right = side if right else Side(None),
+                                       top = side if top else Side(None),
+                                       bottom = side if bottom else Side(None))
+        return self.borders[key]
+
+    def edges(self, top_left, bottom_right, cell):
+        """ Returns which edges of the range `top_left`:`bottom_right` the cell lies on """
+        return (cell.col_idx == top_left.col_idx,
+                cell.col_idx == bottom_right.col_idx,
+                cell.row == top_left.row,
+                cell.row == bottom_right.row)
+
 def get_border(top_left, bottom_right, cell, style = 'medium'):
     """Given a range, return the borders of a cell such that all the cells on
     the edge have the appropriate side borders. If a cell is not on the
@@ -0,0 +1,159 @@
+"""The layout and styles of a report template, read once from the template workbook"""
+
+# Python stdlib imports
+from __future__ import unicode_literals
+from copy import copy
+import logging
+import os
+import pickle
+
+# package imports
+from exhelp import *
+
+# a helper class holding the styles of a single template cell
+class CellStyle:
+
+    def __init__(self, font, fill, border, alignment, number_format, protection):
+        self.font = font
+        self.fill = fill
+        self.border = border
+        self.alignment = alignment
+        self.number_format = number_format
+        self.protection = protection
+
+    def apply(self, cell):
+        cell.font = self.font
+        cell.fill = self.fill
+        cell.border = self.border
+        cell.alignment = self.alignment
+        cell.number_format = self.number_format
+        cell.protection = self.protection
+        return cell
+
+    @staticmethod
+    def from_cell(cell):
+        return CellStyle(font = copy(cell.font),
+                         fill = copy(cell.fill),
+                         border = copy(cell.border),
+                         alignment = copy(cell.alignment),
+                         number_format = cell.number_format,
+                         protection = copy(cell.protection))
+
+# a helper class holding everything the formatter needs to know about a template
+class TemplateLayout:
+
+    def __init__(self, path, title, tags, rows_above_data, row_heights, column_widths,
+                 merged_cells, column_styles, order_id_style, rows_below_data):
+        self.path = path
+        self.title = title
+        self.tags = tags
+        self.rows_above_data = rows_above_data
+        self.row_heights = row_heights
+        self.column_widths = column_widths
+        self.merged_cells = merged_cells
+        self.column_styles = column_styles
+        self.order_id_style = order_id_style
+        self.rows_below_data = rows_below_data
+
+    def tag(self, tag):
+        """ Returns the (row, column) of the first cell holding `tag`, or None """
+        positions = self.tags.get(tag)
+        return (positions[0] if positions else None)
+
+    @staticmethod
+    def from_template(template_path):
+        worksheet = load_workbook(template_path).active
+        tags = TagIndex.from_worksheet(worksheet)
+
+        data_start, data_end = tags.cell('<data_start>'), tags.cell('<data_end>')
+        if not all([data_start, data_end, tags.cell('<header_start>')]):
+            logging.error('Template "{}" is missing its <data_start>, <data_end> or <header_start> tag.'.format(template_path))
+            return None
+
+        # every cell above the data block, as (column, value, style) per row
+        rows_above_data = []
+        for row in worksheet.iter_rows(min_row = 1, max_row = data_start.row - 1,
+                                       min_col = 1, max_col = worksheet.max_column):
+            rows_above_data.append([ (cell.col_idx, cell.value, CellStyle.from_cell(cell))
+                                     for cell in row if cell.value is not None or cell.has_style ])
+
+        # the cells of the data row style the columns of the data block
+        column_styles = [ CellStyle.from_cell(worksheet.cell(row = data_start.row, column = column))
+                          for column in range(data_start.col_idx, data_end.col_idx + 1) ]
+
+        order_id = tags.cell('<order_id>')
+
+        return TemplateLayout(path = template_path,
+                              title = worksheet.title,
+                              tags = dict((tag.value, [ (c.row, c.col_idx) for c in tags.cells(tag.value) ])
+                                          for tag in tags.all_cells()),
+                              rows_above_data = rows_above_data,
+                              row_heights = dict((index, dimension.height)
+                                                 for index, dimension in worksheet.row_dimensions.items()
+                                                 if dimension.height is not None),
+                              column_widths = dict((letter, dimension.width)
+                                                   for letter, dimension in worksheet.column_dimensions.items()
+                                                   if dimension.width),
+                              merged_cells = worksheet.merged_cell_ranges,
+                              column_styles = column_styles,
+                              order_id_style = CellStyle.from_cell(order_id) if order_id else None,
+                              rows_below_data = worksheet.max_row > data_start.row)
+
+# bump this whenever TemplateLayout changes, so that stale cached layouts are ignored
+LAYOUT_VERSION = 1
+
+# the layouts parsed by this process, keyed by template path, modification time and size
+_layouts = {}
+
+def read_cached_layout(cache_path):
+    try:
+        with open(cache_path, 'rb') as cache_file:
+            return pickle.load(cache_file)
+    except Exception as error:
+        logging.debug('Ignoring unreadable cached layout "{}": {}'.format(cache_path, error))
+        return None
+
+def write_cached_layout(cache_path, layout):
+    try:
+        if not os.path.isdir(os.path.dirname(cache_path)):
+            os.makedirs(os.path.dirname(cache_path))
+        with open(cache_path + '.tmp', 'wb') as cache_file:
+            pickle.dump(layout, cache_file, protocol = pickle.HIGHEST_PROTOCOL)
+        os.rename(cache_path + '.tmp', cache_path)
+    except (IOError, OSError) as error:
+        logging.warning('Could not cache the template layout in "{}": {}'.format(cache_path, error))
+
+def get_template_layout(template_path, cache_directory = None):
+    """ Returns the layout of the template, parsing it only if it has changed.
+
+        Layouts are kept in memory for the life of the process, and pickled
+        into `cache_directory` (if given) under the hash of the template's
+        contents, so that later runs and worker processes can skip parsing.
+
+        :rtype: TemplateLayout
+    """
+    stat = os.stat(template_path)
+    key = (os.path.abspath(template_path), stat.st_mtime, stat.st_size)
+    if key in _layouts:
+        return _layouts[key]
+
+    layout, cache_path = None, None
+    if cache_directory:
+        cache_path = os.path.join(cache_directory, 'template-{}-v{}.pickle'.format(file_hash(template_path),
+                                                                                  LAYOUT_VERSION))
+        if os.path.isfile(cache_path):
+            layout = read_cached_layout(cache_path)
+
+    if layout is None:
+        logging.debug('Parsing template "{}"...'.format(template_path))
+        layout = TemplateLayout.from_template(template_path)
+        if layout and cache_path:
+            write_cached_layout(cache_path, layout)
+    else:
+        logging.debug('Using the cached layout of template "{}".'.format(template_path))
+
+    # the same template may have been cached from another path
+    if layout:
+        layout.path = template_path
+    _layouts[key] = layout
+    return layout
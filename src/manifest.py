@@ -0,0 +1,87 @@
+"""A record of what each formatted report was built from, so that re-runs can
+skip the reports whose inputs have not changed"""
+
+# Python stdlib imports
+from __future__ import unicode_literals
+import hashlib
+import json
+import logging
+import os
+
+# package imports
+from common import *
+from config import OUTPUT_SETTINGS
+
+def config_hash(config):
+    """ Returns a hash of the settings that change what a formatted report looks like """
+    settings = dict((setting, config[setting]) for setting in OUTPUT_SETTINGS)
+    return hashlib.sha1(json.dumps(settings, sort_keys = True).encode('utf-8')).hexdigest()
+
+def build_fingerprint(input_path, config):
+    """ Returns the hashes of everything a formatted report is built from: the
+        input, the template, the icon and the config.
+
+        :rtype: dict
+    """
+    return {'input': file_hash(input_path),
+            'template': file_hash(config['Template']),
+            'icon': file_hash(config['Icon']),
+            'config': config_hash(config)}
+
+def output_stamp(output_path):
+    """ Returns the size and modification time of an output, or None if there isn't one """
+    if not os.path.isfile(output_path):
+        return None
+    return [os.path.getsize(output_path), os.path.getmtime(output_path)]
+
+class Manifest:
+    """ The fingerprint of each report in an outputs directory, along with the
+        size and modification time of each output when it was built (so that
+        an output edited or replaced since is rebuilt, not skipped). A report
+        split into orders has an output for each order.
+    """
+
+    FILENAME = '.manifest.json'
+
+    def __init__(self, path, entries = None):
+        self.path = path
+        self.entries = entries if entries is not None else {}
+
+    @staticmethod
+    def load(outputs_directory):
+        path = os.path.join(outputs_directory, Manifest.FILENAME)
+        if not os.path.isfile(path):
+            return Manifest(path)
+        try:
+            with open(path) as manifest_file:
+                return Manifest(path, json.load(manifest_file))
+        except ValueError:
+            logging.warning('Ignoring unreadable manifest "{}"; every report will be rebuilt.'.format(path))
+            return Manifest(path)
+
+    def is_built_output(self, output_path):
+        """ Whether the output (or each output of a split report) is exactly as this formatter last built it """
+        entry = self.entries.get(os.path.basename(output_path))
+        if entry is None:
+            return False
+
+        directory = os.path.dirname(self.path)
+        return all([ stamp == output_stamp(os.path.join(directory, name)) for name, stamp in entry['outputs'].items() ])
+
+    def is_current(self, output_path, fingerprint):
+        """ Whether the output was built from exactly these inputs and is unchanged since """
+        entry = self.entries.get(os.path.basename(output_path))
+        return self.is_built_output(output_path) and entry['fingerprint'] == fingerprint
+
+    def record(self, output_path, fingerprint, output_paths = None):
+        """ :param output_paths: the outputs actually written, if not just `output_path` (e.g. one per order) """
+        outputs = dict((os.path.basename(path), output_stamp(path)) for path in (output_paths or [output_path]))
+        self.entries[os.path.basename(output_path)] = {'fingerprint': fingerprint,
+                                                       'outputs': outputs}
+
+    def save(self):
+        with open(self.path + '.tmp', 'w') as manifest_file:
+            json.dump(self.entries, manifest_file, indent = 2, sort_keys = True)
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+        os.rename(self.path + '.tmp', self.path)
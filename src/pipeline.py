@@ -0,0 +1,116 @@
+"""Formats reports one at a time as a pipeline, overlapping the reading of
+the next input and the saving of the last output with the formatting of the
+current one.
+
+Reading an input (parsing the file, then cleaning it) and saving an output
+(compressing the workbook and writing it out) spend much of their time waiting
+on the disk, or on zlib, both of which let other threads run. Each runs on a
+thread of its own, so that while report N is formatted:
+
+    * up to `Prefetch` of the inputs after it are read and cleaned, and
+    * up to `Prefetch` of the reports before it are saved.
+
+The number held at once bounds the memory the pipeline takes up. Stage
+timings are wall-clock times, so a stage that overlaps another may appear
+slower than it would alone.
+"""
+
+# Python stdlib imports
+from __future__ import unicode_literals
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+import logging
+
+# package imports
+from reporter import *
+
+def save_report(wrapped_workbook, df_clean, input_path, order_id, inputs, profiler):
+    """ Saves a report formatted by reporter.format_workbook, returning its summary """
+    profiler.run('save_workbook', save_workbook, wrapped_workbook)
+    logging.info('Workbook "{}" formatting complete!\n'.format(wrapped_workbook.path))
+    return report_summary(df_clean, input_path, wrapped_workbook.path, order_id, inputs, profiler,
+                          formula_values = wrapped_workbook.formula_values)
+
+def format_reports_pipelined(input_paths, inputs, reader, validators, cleaners, columns_to_merge, template_layout = None):
+    """ Formats each of the input reports as reporter.format_report does,
+        reading and saving them on threads of their own so that they overlap
+        with formatting, and returns their summaries in the order of
+        `input_paths`.
+    """
+    depth = inputs['Prefetch']
+
+    # tracemalloc traces every thread at once, so the stages can't overlap while it runs
+    if inputs['Trace Memory']:
+        logging.info('Memory is being traced, so the reports are formatted one at a time.')
+        return [ summary for path in input_paths
+                 for summary in format_report(path, inputs, reader, validators, cleaners, columns_to_merge, template_layout) ]
+
+    def read(input_path):
+        profiler = Profiler(trace_memory = False)
+        return profiler, read_and_clean(input_path, reader, validators, cleaners, profiler, build_audit_log(input_path, inputs),
+                                        inputs['Split Orders'])
+
+    summaries = []
+
+    def collect(saves, limit):
+        # wait for the oldest saves to finish until no more than `limit` are still running
+        while len(saves) > limit:
+            output_path, future = saves.popleft()
+            try:
+                summary = future.result()
+            except Exception:
+                logging.exception('Saving "{}" failed; report will be skipped.'.format(output_path))
+                continue
+            if summary:
+                summaries.append(summary)
+
+    logging.info('Formatting {} reports, reading up to {} ahead...'.format(len(input_paths), depth))
+
+    with ThreadPoolExecutor(max_workers = 1) as reading, ThreadPoolExecutor(max_workers = 1) as saving:
+        pending = iter(input_paths)
+        reads = deque([ (path, reading.submit(read, path)) for path in islice(pending, depth) ])
+        saves = deque()
+
+        while reads:
+            input_path, future = reads.popleft()
+            next_path = next(pending, None)
+            if next_path is not None:
+                reads.append((next_path, reading.submit(read, next_path)))
+
+            try:
+                profiler, report = future.result()
+            except Exception:
+                logging.exception('Reading "{}" failed; report will be skipped.'.format(input_path))
+                continue
+            if report is None:
+                continue
+            df_raw, df_clean, orders = report
+
+            if inputs['Split Orders']:
+                logging.info('Read, cleaned and split "{}" into {} orders in {:.3f}s.'.format(input_path, len(orders), profiler.total_seconds))
+                collect(saves, 0)
+                summaries.extend(format_orders(input_path, orders, inputs, columns_to_merge, template_layout))
+                continue
+
+            output_path = get_output_path(input_path, inputs['Outputs Directory'])
+            order_id = extract_order_id(df_raw['Line Item'][0])
+
+            # a streamed report is written as it is formatted, so the whole of it is done on the saving thread
+            if inputs['Output Mode'] == 'streaming':
+                saves.append((output_path, saving.submit(write_report, df_clean, input_path, output_path, order_id, inputs,
+                                                         columns_to_merge, template_layout, profiler)))
+            else:
+                try:
+                    wrapped_workbook = format_workbook(df_clean, output_path, order_id, inputs, columns_to_merge, template_layout, profiler)
+                except Exception:
+                    logging.exception('Formatting "{}" failed; report will be skipped.'.format(input_path))
+                    continue
+                if wrapped_workbook:
+                    saves.append((output_path, saving.submit(save_report, wrapped_workbook, df_clean, input_path, order_id, inputs, profiler)))
+
+            collect(saves, depth)
+
+        collect(saves, 0)
+
+    return summaries
@@ -0,0 +1,190 @@
+"""Plans a chain of cleaners so that it runs in as few passes over the data,
+and with as few copies of it, as possible.
+
+Run one after another, each cleaner that drops rows or columns copies the
+frame. The plan instead:
+
+    * evaluates every row filter against the raw frame up front and combines
+      them into a single mask, keeping each filter's "ignore me if I would
+      drop every row" behaviour;
+    * prunes the columns that no cleaner reads and the report does not need
+      at the same time, so the rows and columns are selected in one copy;
+    * then runs the cleaners that rewrite values in place, in their order.
+
+A cleaner that the plan knows nothing about (see cleaners.CLEANER_COLUMNS)
+could read or write anything, so a chain holding one runs as it is.
+"""
+
+# Python stdlib imports
+from __future__ import unicode_literals
+import logging
+
+# third party imports
+import numpy
+
+# package imports
+from cleaners import *
+
+FILTER, MAP, SELECT = 'filter', 'map', 'select'
+
+def run_stage(name, f, x):
+    return f(x)
+
+def count_changes(before, after):
+    """ Returns the number of values that differ between two frames of the same shape, treating NaNs as equal """
+    changed = (before.values != after.values) & ~(before.isnull().values & after.isnull().values)
+    return int(changed.sum())
+
+# a helper class holding a cleaner along with what it does to a frame
+class CleanerStep:
+
+    def __init__(self, cleaner, name, kind, reads, writes):
+        self.cleaner = cleaner
+        self.name = name
+        self.kind = kind
+        self.reads = reads
+        self.writes = writes
+
+    @property
+    def arguments(self):
+        return getattr(self.cleaner, 'keywords', None) or {}
+
+    @staticmethod
+    def from_cleaner(cleaner):
+        """ Returns the step for a cleaner (a partial of one of the functions in
+            cleaners.CLEANER_COLUMNS), or None if it can't be planned.
+        """
+        name = getattr(getattr(cleaner, 'func', cleaner), '__name__', None)
+        if name not in CLEANER_COLUMNS or getattr(cleaner, 'args', None):
+            return None
+
+        reads, writes = CLEANER_COLUMNS[name](**(getattr(cleaner, 'keywords', None) or {}))
+        kind = (FILTER if name in ROW_FILTERS else
+                SELECT if name in ['drop_columns_not_required', 'reorder_columns'] else
+                MAP)
+        return CleanerStep(cleaner, name, kind, reads, writes)
+
+class CleanerPlan:
+
+    def __init__(self, cleaners):
+        self.cleaners = cleaners
+        steps = [ CleanerStep.from_cleaner(cleaner) for cleaner in cleaners ]
+        self.is_planned = all(steps)
+
+        self.filters, self.steps = [], []
+        if not self.is_planned:
+            logging.debug('Not every cleaner can be planned; running them one after another.')
+            return
+
+        # a filter can run first unless an earlier cleaner rewrites the column it tests
+        written = set()
+        for step in steps:
+            if step.kind == FILTER and not written.intersection(step.reads):
+                self.filters.append(step)
+            else:
+                self.steps.append(step)
+                written.update(step.writes)
+
+        # until the columns are dropped, keep those that the cleaners before then read
+        drop = next((step for step in self.steps if step.name == 'drop_columns_not_required'), None)
+        self.required_columns = None
+        if drop:
+            self.required_columns = list(drop.reads)
+            earlier_reads = [ column for step in self.steps[:self.steps.index(drop)] for column in step.reads ]
+            self.kept_columns = set(self.required_columns + earlier_reads)
+
+    def describe(self):
+        """ Returns a line describing each stage of the plan """
+        if not self.is_planned:
+            return [ 'run {}'.format(getattr(getattr(c, 'func', c), '__name__', c)) for c in self.cleaners ]
+
+        lines = []
+        if self.filters or self.required_columns is not None:
+            lines.append('select the rows and columns in a single pass, filtering rows by {}{}'.format(
+                ', then '.join([ step.name for step in self.filters ]) or 'nothing',
+                '; keeping only the columns that are required or read by a cleaner' if self.required_columns is not None else ''))
+        for step in self.steps:
+            lines.append('{} {}'.format('run' if step.kind != SELECT else 'select columns by', step.name))
+        return lines
+
+    def filter_rows(self, df, changes, strict = False):
+        """ Returns a mask of the rows that survive all the filters, applying
+            them in turn as drop_rows_matching would: a filter that would drop
+            every remaining row is ignored (unless `strict` is set, as it is for
+            a chunk of a larger report), and one that drops nothing leaves the
+            rows it can't test (e.g. blanks) in place.
+        """
+        alive = numpy.ones(len(df), dtype = bool)
+        for step in self.filters:
+            matches, description = ROW_FILTERS[step.name](df, **step.arguments)
+            keep_rows = alive & matches.eq(False).values
+            drop_rows = alive & matches.eq(True).values
+
+            if not keep_rows.any() and not strict:
+                logging.error('All rows have been filtered out where {}. Ignoring cleaning step.'.format(description))
+                changes.append((step.name, 'would drop every row where {}; ignored'.format(description)))
+                continue
+
+            if not drop_rows.any():
+                changes.append((step.name, 'drops no rows'))
+                continue
+
+            audit_rows(df[drop_rows], step.name, 'Removing', description)
+            changes.append((step.name, 'drops {} row(s) where {}'.format(int(alive.sum() - keep_rows.sum()), description)))
+            alive = keep_rows
+        return alive
+
+    def select(self, df, changes, strict = False):
+        alive = self.filter_rows(df, changes, strict)
+
+        columns = df.columns.tolist()
+        if self.required_columns is not None:
+            columns = [ column for column in columns if column in self.kept_columns ]
+            changes.append(('drop_columns_not_required', 'drops {} column(s) up front'.format(len(df.columns) - len(columns))))
+
+        # a single copy of the rows and columns that the rest of the plan works on
+        return df.loc[alive, columns]
+
+    def drop_columns(self, df, changes):
+        unused_columns = [ column for column in df.columns if column not in self.required_columns ]
+        if unused_columns:
+            changes.append(('drop_columns_not_required', 'drops {}, kept until now for the cleaners above'.format(
+                ', '.join(unused_columns))))
+            return df.drop(unused_columns, axis = 1)
+        return df
+
+    def execute(self, df, run = run_stage, dry_run = False, strict_filters = False):
+        """ Cleans the frame, returning it along with a list of (cleaner,
+            description) of what each step changed. With `dry_run` set the
+            changes to each value are counted too, which takes longer.
+
+            :param run: runs each stage as run(name, f, df), e.g. Profiler.run
+            :param strict_filters: apply each row filter even if it drops every row
+        """
+        changes = []
+        if not self.is_planned:
+            for cleaner in self.cleaners:
+                df = run(getattr(getattr(cleaner, 'func', cleaner), '__name__', repr(cleaner)), cleaner, df)
+            return df, changes
+
+        if self.filters or self.required_columns is not None:
+            df = run('select_rows_and_columns', lambda df: self.select(df, changes, strict_filters), df)
+
+        for step in self.steps:
+            if step.name == 'drop_columns_not_required':
+                df = run(step.name, lambda df: self.drop_columns(df, changes), df)
+                continue
+
+            before = df[step.writes].copy() if dry_run and step.writes else None
+            df = run(step.name, step.cleaner, df)
+
+            if before is not None:
+                changes.append((step.name, 'changes {} value(s) in {}'.format(count_changes(before, df[step.writes]),
+                                                                              ', '.join(step.writes))))
+            elif dry_run:
+                changes.append((step.name, 'orders the columns as {}'.format(', '.join(df.columns))))
+
+        return df, changes
+
+    def __call__(self, df):
+        return self.execute(df)[0]
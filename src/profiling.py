@@ -0,0 +1,137 @@
+"""Per-stage timings and memory use for the formatting pipeline"""
+
+# Python stdlib imports
+from __future__ import division, unicode_literals
+from functools import partial
+from timeit import default_timer
+import csv
+import io
+import json
+import logging
+
+# package imports
+from common import *
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+def stage_name(f):
+    """ Returns the name of the function wrapped by `f`, which may be a partial """
+    return getattr(getattr(f, 'func', f), '__name__', repr(f))
+
+def count_rows(x):
+    """ Returns the number of rows in a dataframe, or None for anything else """
+    return len(x) if hasattr(x, 'columns') else None
+
+def check_result(x):
+    """ Returns whether a validator passed, or None for anything other than a bool """
+    return x if isinstance(x, bool) else None
+
+def count_cells_held(x):
+    """ Returns the number of cells within the used range of a WrappedWorkbook's
+        sheet after a stage (not those the stage itself wrote), or None for anything else
+    """
+    worksheet = getattr(x, 'worksheet', None)
+    return worksheet.max_row * worksheet.max_column if worksheet is not None else None
+
+# a helper class holding the measurements of a single stage
+class StageMetrics:
+
+    FIELDS = ['stage', 'seconds', 'peak_memory_mb', 'rows_in', 'rows_out', 'cells_held', 'passed']
+
+    def __init__(self, stage, seconds, peak_memory_mb = None, rows_in = None, rows_out = None, cells_held = None, passed = None):
+        self.stage = stage
+        self.seconds = seconds
+        self.peak_memory_mb = peak_memory_mb
+        self.rows_in = rows_in
+        self.rows_out = rows_out
+        self.cells_held = cells_held
+        self.passed = passed
+
+    def as_dict(self):
+        return dict((field, getattr(self, field)) for field in StageMetrics.FIELDS)
+
+    def describe(self):
+        details = ['{:.3f}s'.format(self.seconds)]
+        if self.peak_memory_mb is not None:
+            details.append('{:.1f} MB peak'.format(self.peak_memory_mb))
+        if self.rows_in is not None and self.rows_out is not None:
+            details.append('{} -> {} rows'.format(self.rows_in, self.rows_out))
+        elif self.rows_in is not None or self.rows_out is not None:
+            details.append('{} rows'.format(self.rows_in if self.rows_in is not None else self.rows_out))
+        if self.cells_held is not None:
+            details.append('{} cells held'.format(self.cells_held))
+        if self.passed is not None:
+            details.append('passed' if self.passed else 'failed')
+        return ', '.join(details)
+
+class Profiler:
+    """ Runs the stages of the pipeline, recording how long each took, the
+        most memory it allocated at once (if `trace_memory` is set) and the
+        size of its input and output, or whether it passed for a validator.
+
+        Tracing memory slows the stages down several times over, so it is off
+        by default and the timings are only comparable between runs that
+        both trace memory or both don't.
+    """
+
+    def __init__(self, trace_memory = False):
+        self.trace_memory = trace_memory and tracemalloc is not None
+        self.stages = []
+
+    def run(self, name, f, x):
+        rows_in = count_rows(x)
+
+        if self.trace_memory:
+            tracemalloc.start()
+        start = default_timer()
+        try:
+            result = f(x)
+        finally:
+            seconds = default_timer() - start
+            peak_memory_mb = None
+            if self.trace_memory:
+                peak_memory_mb = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+                tracemalloc.stop()
+
+        self.stages.append(StageMetrics(stage = name,
+                                        seconds = seconds,
+                                        peak_memory_mb = peak_memory_mb,
+                                        rows_in = rows_in,
+                                        rows_out = count_rows(result),
+                                        cells_held = count_cells_held(result),
+                                        passed = check_result(result)))
+        return result
+
+    def bind(self, x, f):
+        """ A profiled common.bind """
+        return bind(x, partial(self.run, stage_name(f), f))
+
+    def call(self, x, f):
+        """ A profiled f(x), for use in a reduce over the cleaners """
+        return self.run(stage_name(f), f, x)
+
+    @property
+    def total_seconds(self):
+        return sum(stage.seconds for stage in self.stages)
+
+    def write(self, path, metrics_format = 'json'):
+        logging.debug('Writing metrics to "{}"...'.format(path))
+        rows = [ stage.as_dict() for stage in self.stages ]
+
+        if metrics_format == 'csv':
+            with io.open(path, 'w', newline = '') as metrics_file:
+                writer = csv.DictWriter(metrics_file, fieldnames = StageMetrics.FIELDS)
+                writer.writeheader()
+                writer.writerows(rows)
+        else:
+            with open(path, 'w') as metrics_file:
+                metrics_file.write(json.dumps({'total_seconds': self.total_seconds, 'stages': rows}, indent = 2))
+        return path
+
+    def summary(self):
+        """ Returns the metrics as (label, value) pairs for the summary log """
+        return ([('Total seconds', '{:.3f}'.format(self.total_seconds))] +
+                [ ('  ' + stage.stage, stage.describe()) for stage in self.stages ])
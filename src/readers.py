@@ -0,0 +1,332 @@
+"""Readers for the input reports, which load only the columns the formatter
+uses from an Excel, CSV or Parquet export.
+
+Excel exports are read with calamine (via the python-calamine package) if it
+is installed, as it parses several times faster than xlrd; otherwise with
+xlrd, as pandas.read_excel would, though the sheet is parsed just the once
+and only the columns used are kept. openpyxl's read-only mode can be chosen
+instead where memory matters more than speed.
+
+Reports too large to hold in memory can instead be read a chunk of rows at a
+time with read_report_chunks (see chunked.py).
+
+Given a schema (see validators.ReportSchema), each reader first checks the
+header row and the first few rows of a report against it, so that a report
+missing a column, with its columns out of order or holding the wrong kind of
+value is rejected before the rest of it is parsed.
+"""
+
+# Python stdlib imports
+from __future__ import unicode_literals
+from itertools import chain, islice
+import logging
+import os
+
+# third party imports
+import numpy
+import openpyxl
+import pandas
+import xlrd
+
+# package imports
+from past.builtins import basestring
+
+try:
+    from python_calamine import CalamineWorkbook
+except ImportError:
+    CalamineWorkbook = None
+
+def available_engines():
+    return (['calamine'] if CalamineWorkbook else []) + ['openpyxl', 'pandas']
+
+def select_engine(input_path, engine = 'auto'):
+    extension = os.path.splitext(input_path)[1].lower()
+    if extension == '.csv':
+        return 'csv'
+    if extension == '.parquet':
+        return 'parquet'
+    if engine != 'auto':
+        return engine
+    # xlrd (which pandas uses) parses faster than openpyxl's read-only mode,
+    # though openpyxl holds less of the file in memory at once
+    return 'calamine' if CalamineWorkbook else 'pandas'
+
+def frame_from_rows(rows, columns, text_columns = [], positions = None):
+    """ Returns a dataframe of the `columns` of the sheet `rows`, the first
+        of which holds the headers. The values are typed as pandas.read_excel
+        types them: blank cells become NaN, and whole numbers become ints
+        where a column has no blanks.
+
+        :param positions: the positions of the `columns` in each row, if already known
+    """
+    rows = iter(rows)
+    headers = list(next(rows, []))
+    if positions is None:
+        positions = [ index for index, header in enumerate(headers) if header in columns ]
+
+    records = [ [ row[index] if index < len(row) else None for index in positions ] for row in rows ]
+    df = pandas.DataFrame.from_records(records, columns = [ headers[index] for index in positions ], coerce_float = True)
+    df = df.where(df.notnull() & (df != ''), numpy.nan)
+
+    for column in df.columns:
+        if column in text_columns:
+            continue
+        if df[column].dtype == object:
+            df[column] = pandas.to_numeric(df[column], errors = 'ignore')
+        if df[column].dtype == float and df[column].notnull().all() and (df[column] % 1 == 0).all():
+            df[column] = df[column].astype('int64')
+
+    return df
+
+def read_with_openpyxl(input_path, sheet_name, columns, text_columns, schema = None, date_columns = []):
+    workbook = openpyxl.load_workbook(input_path, read_only = True, data_only = True)
+    try:
+        rows = ( [ cell.value for cell in row ] for row in workbook[sheet_name].iter_rows() )
+        return frame_from_checked_rows(rows, columns, text_columns, schema, date_columns)
+    finally:
+        # read-only workbooks keep the file open until they are closed
+        if hasattr(workbook, '_archive'):
+            workbook._archive.close()
+
+def read_with_calamine(input_path, sheet_name, columns, text_columns, schema = None, date_columns = []):
+    sheet = CalamineWorkbook.from_path(input_path).get_sheet_by_name(sheet_name)
+    return frame_from_checked_rows(sheet.to_python(skip_empty_area = False), columns, text_columns, schema, date_columns)
+
+def xlrd_value(value, kind, datemode):
+    if kind == xlrd.XL_CELL_DATE:
+        return xlrd.xldate.xldate_as_datetime(value, datemode)
+    return None if kind in (xlrd.XL_CELL_EMPTY, xlrd.XL_CELL_BLANK) else value
+
+def xlrd_rows(book, sheet):
+    """ Yields the rows of an xlrd sheet as lists of values, with its dates as datetimes and its blanks as None """
+    for index in range(sheet.nrows):
+        yield [ xlrd_value(value, kind, book.datemode) for value, kind in zip(sheet.row_values(index), sheet.row_types(index)) ]
+
+def read_with_xlrd(input_path, sheet_name, columns, text_columns, schema = None, date_columns = []):
+    # xlrd parses the whole of an xlsx sheet as it opens it, so the schema is first checked
+    # from the top of the sheet, read with openpyxl; only an xls sheet is parsed on demand
+    positions = None
+    if schema is not None and os.path.splitext(input_path)[1].lower() != '.xls':
+        head = iter_sheet_rows(input_path, sheet_name, 'openpyxl')
+        try:
+            positions, _ = check_rows(head, schema, date_columns, text_columns)
+        finally:
+            head.close()
+        if positions is None:
+            return None
+
+    # the sheet is parsed once, and the frame built from its rows as the other engines build theirs
+    book = xlrd.open_workbook(input_path, on_demand = True)
+    try:
+        rows = xlrd_rows(book, book.sheet_by_name(sheet_name))
+        if positions is not None:
+            return frame_from_rows(rows, columns, text_columns, positions)
+        return frame_from_checked_rows(rows, columns, text_columns, schema, date_columns)
+    finally:
+        book.release_resources()
+
+def csv_options(input_path, columns, date_columns, text_columns, positions = None):
+    """ Returns the options for pandas.read_csv that read just the `columns` of the report at `input_path` """
+    headers = list(pandas.read_csv(input_path, nrows = 0).columns) if positions is None else None
+    usecols = [ header for header in headers if header in columns ] if positions is None else positions
+    names = usecols if positions is None else columns
+    return {'usecols': usecols,
+            'dtype': dict((column, object) for column in text_columns if column in names),
+            'parse_dates': [ column for column in date_columns if column in names ]}
+
+def check_csv(input_path, schema, date_columns, text_columns):
+    """ Checks the CSV report at `input_path` against `schema` from its first
+        few rows, returning the positions of the schema's columns, or None.
+    """
+    headers = list(pandas.read_csv(input_path, nrows = 0).columns)
+    positions = schema.check_headers(headers)
+    if positions is None:
+        return None
+    sample = pandas.read_csv(input_path, nrows = SAMPLE_ROWS, **csv_options(input_path, schema.required_columns, date_columns, text_columns, positions))
+    return positions if schema.check_values(convert_dates(sample, date_columns)) else None
+
+def read_csv(input_path, columns, date_columns, text_columns, schema = None):
+    positions = None
+    if schema is not None:
+        positions = check_csv(input_path, schema, date_columns, text_columns)
+        if positions is None:
+            return None
+    return convert_dates(pandas.read_csv(input_path, **csv_options(input_path, columns, date_columns, text_columns, positions)), date_columns)
+
+def read_parquet(input_path, columns):
+    if not hasattr(pandas, 'read_parquet'):
+        raise ValueError('Reading "{}" requires pandas 0.21 or later with pyarrow or fastparquet.'.format(input_path))
+    frame = pandas.read_parquet(input_path)
+    return frame[[ column for column in frame.columns if column in columns ]]
+
+def parse_date(value):
+    """ Returns the text of a date as a datetime, and any other value (e.g. 'Unlimited') as it is """
+    if not isinstance(value, basestring):
+        return value
+    try:
+        return pandas.to_datetime(value)
+    except ValueError:
+        return value
+
+def convert_dates(df, date_columns):
+    # the row-by-row readers leave a column of dates as objects, and read_csv leaves
+    # the text of a column holding any 'Unlimited', so those are parsed value by value
+    for column in date_columns:
+        if column in df.columns and df[column].dtype == object:
+            df[column] = pandas.to_datetime(df[column], errors = 'ignore')
+            if df[column].dtype == object:
+                df[column] = df[column].map(parse_date)
+    return df
+
+# the rows read from the top of a report to check the kind of value in each column
+SAMPLE_ROWS = 100
+
+def check_rows(rows, schema, date_columns = [], text_columns = []):
+    """ Checks the sheet `rows` (the headers first) against `schema` (see
+        validators.ReportSchema) from the header row and the first
+        SAMPLE_ROWS rows, before any more of them are read.
+
+        :return: the positions of the schema's required columns in the header
+            row (None if the rows do not fit the schema), and all of the rows
+        :rtype: Tuple(List[int], Iterator)
+    """
+    rows = iter(rows)
+    head = list(islice(rows, SAMPLE_ROWS + 1))
+
+    positions = schema.check_headers(list(head[0]) if head else [])
+    if positions is not None:
+        sample = convert_dates(frame_from_rows(head, schema.required_columns, text_columns, positions), date_columns)
+        if not schema.check_values(sample):
+            positions = None
+    return positions, chain(head, rows)
+
+def check_frame(df, schema):
+    """ Whether a report read in full fits `schema`, from its columns and first SAMPLE_ROWS rows """
+    return schema.check_headers(list(df.columns)) is not None and schema.check_values(df[:SAMPLE_ROWS])
+
+def frame_from_checked_rows(rows, columns, text_columns, schema = None, date_columns = []):
+    """ As frame_from_rows, but the rows are first checked against `schema`
+        (if given; see check_rows), and None is returned if they do not fit it.
+    """
+    positions = None
+    if schema is not None:
+        positions, rows = check_rows(rows, schema, date_columns, text_columns)
+        if positions is None:
+            return None
+    return frame_from_rows(rows, columns, text_columns, positions)
+
+def read_report(input_path, sheet_name, columns, date_columns = [], text_columns = [], engine = 'auto', schema = None):
+    """ Reads the `columns` of the report at `input_path`, in the order they
+        appear in the file; any other columns are skipped.
+
+        :param sheet_name: the sheet holding the report, for Excel inputs
+        :param date_columns: columns to parse as datetimes, where they hold dates
+        :param text_columns: columns to keep as text, rather than inferring their type
+        :param engine: one of 'auto', 'calamine', 'openpyxl' or 'pandas'
+        :param schema: if given, the report is checked against it from its
+            first few rows before the rest is parsed (see check_rows), and
+            only the columns found then are parsed
+
+        :return: the report, or None if it does not fit the schema
+        :rtype: pandas.DataFrame
+    """
+    engine = select_engine(input_path, engine)
+    logging.debug('Reading "{}" with the {} reader...'.format(input_path, engine))
+
+    if engine == 'csv':
+        return read_csv(input_path, columns, date_columns, text_columns, schema)
+    elif engine == 'parquet':
+        df = read_parquet(input_path, columns)
+        if schema is not None and not check_frame(df, schema):
+            return None
+    elif engine == 'calamine':
+        df = read_with_calamine(input_path, sheet_name, columns, text_columns, schema, date_columns)
+    elif engine == 'openpyxl':
+        df = read_with_openpyxl(input_path, sheet_name, columns, text_columns, schema, date_columns)
+    elif engine == 'pandas':
+        df = read_with_xlrd(input_path, sheet_name, columns, text_columns, schema, date_columns)
+    else:
+        raise ValueError('Unknown input engine "{}"; expected one of: auto, {}'.format(engine, ', '.join(available_engines())))
+
+    return convert_dates(df, date_columns) if df is not None else None
+
+# a generous estimate of the memory a cell takes up at once as a chunk is
+# read, cleaned and sorted (the row from the sheet, the frame and its copies)
+BYTES_PER_CELL = 1024
+
+def rows_within_budget(memory_budget, column_count):
+    """ Returns the number of rows of `column_count` columns that can be worked on at once within `memory_budget` MB """
+    return max(1000, int(memory_budget * (1 << 20) // (BYTES_PER_CELL * max(column_count, 1))))
+
+def iter_sheet_rows(input_path, sheet_name, engine):
+    """ Yields the rows of a sheet as lists of values, the headers first,
+        without loading the whole sheet into memory.
+    """
+    if engine == 'calamine':
+        for row in CalamineWorkbook.from_path(input_path).get_sheet_by_name(sheet_name).iter_rows():
+            yield row
+        return
+
+    workbook = openpyxl.load_workbook(input_path, read_only = True, data_only = True)
+    try:
+        for row in workbook[sheet_name].iter_rows():
+            yield [ cell.value for cell in row ]
+    finally:
+        if hasattr(workbook, '_archive'):
+            workbook._archive.close()
+
+def read_report_chunks(input_path, sheet_name, columns, date_columns = [], text_columns = [], engine = 'auto', chunk_rows = 50000,
+                       schema = None):
+    """ Reads the report at `input_path` as read_report does, but yields it
+        as frames of up to `chunk_rows` rows, indexed by their position in the
+        whole report. At least one frame (empty, if the report is) is yielded,
+        unless the report does not fit the `schema`, when none are.
+
+        Excel inputs are read row by row with calamine if it is installed, or
+        openpyxl's read-only mode otherwise, as xlrd loads the whole sheet.
+    """
+    engine = select_engine(input_path, engine)
+    if engine == 'csv':
+        positions = None
+        if schema is not None:
+            positions = check_csv(input_path, schema, date_columns, text_columns)
+            if positions is None:
+                return
+        chunks = pandas.read_csv(input_path, chunksize = chunk_rows, **csv_options(input_path, columns, date_columns, text_columns, positions))
+        for chunk in chunks:
+            yield convert_dates(chunk, date_columns)
+        return
+
+    if engine == 'parquet':
+        df = read_parquet(input_path, columns)
+        if schema is not None and not check_frame(df, schema):
+            return
+        for start in range(0, max(len(df), 1), chunk_rows):
+            yield df[start:start + chunk_rows]
+        return
+
+    if engine not in ['calamine', 'openpyxl']:
+        engine = 'calamine' if CalamineWorkbook else 'openpyxl'
+    logging.debug('Reading "{}" in chunks of {} rows with the {} reader...'.format(input_path, chunk_rows, engine))
+
+    rows = iter_sheet_rows(input_path, sheet_name, engine)
+    positions = None
+    if schema is not None:
+        positions, rows = check_rows(rows, schema, date_columns, text_columns)
+        if positions is None:
+            return
+
+    headers = list(next(rows, []))
+    start = 0
+    while True:
+        block = list(islice(rows, chunk_rows))
+        if not block and start > 0:
+            return
+
+        df = frame_from_rows([headers] + block, columns, text_columns, positions)
+        df.index += start
+        yield convert_dates(df, date_columns)
+
+        if not block:
+            return
+        start += len(block)
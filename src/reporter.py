@@ -1,24 +1,32 @@
 # coding: utf-8
 from builtins import dict, input
+from collections import defaultdict
 
+from audit import *
 from cleaners import *
+from config import *
+from profiling import *
+from readers import *
 from exhelp import *
+from layout import *
+from manifest import *
+from plan import *
 from functools import reduce
 from validators import *
 
+from concurrent.futures import ProcessPoolExecutor
 from copy import copy
 from openpyxl.drawing.image import Image
 from openpyxl.styles import Alignment, Font, PatternFill
-from openpyxl.utils.dataframe import dataframe_to_rows
+from openpyxl.utils import get_column_letter
 
 from functools import partial
+import argparse
 import logging
 import numpy
-import openpyxl
 import os
 import pandas
 import re
-import shutil
 import sys
 import warnings
 import xlrd
@@ -26,14 +34,31 @@ import xlrd
 logging.basicConfig(level = logging.INFO, format = '%(message)s')
 pandas.options.mode.chained_assignment = None  # default='warn'
 
-# a helper class to provide additional metadata to a Workbook
+# a helper class to provide additional metadata to a Workbook, and the worksheet the report is written to
 class WrappedWorkbook:
 
-    def __init__(self, workbook, path = None, start_marker = None, end_marker = None):
+    def __init__(self, workbook, worksheet = None, path = None, start_marker = None, end_marker = None, tags = None, groups = None,
+                 headers = None, formula_values = None):
         self.workbook = workbook
+        self.worksheet = worksheet if worksheet is not None else workbook.active
         self.path = path
         self.start_marker = start_marker
         self.end_marker = end_marker
+        self.tags = tags if tags is not None else TagIndex.from_worksheet(self.worksheet)
+        self.groups = groups if groups is not None else []
+        self.headers = headers if headers is not None else []
+        self.formula_values = formula_values
+
+# a helper class to record the rows that a group of line items was written to
+class GroupSpan:
+
+    def __init__(self, first_row, size):
+        self.first_row = first_row
+        self.size = size
+
+    @property
+    def last_row(self):
+        return self.first_row + self.size - 1
 
 # a helper class to handle the parsing and processing of subtotal rows
 class SubTotal:
@@ -46,10 +71,9 @@ class SubTotal:
         self.group_size = int(group_size)
         self.group_type = group_type
 
-    # return all the cells in this group (not including the subtotal cell)
-    def cells_above_in_group(self):
-        cells_above = [ self.cell.offset(row = -i) for i in range(self.group_size, 0, -1) ]
-        return sorted(cells_above, key = lambda c: c.coordinate)
+    # return the first and last rows of this group (not including the subtotal row)
+    def rows_in_group(self):
+        return (self.cell.row - self.group_size, self.cell.row - 1)
 
     @staticmethod
     def from_cell(cell):
@@ -78,6 +102,69 @@ class Total:
     def build_label(group_type):
         return Total.FORMAT.format(group_type = group_type)
 
+# a helper class that works out the value of each subtotal and total formula
+# (see get_total_value) from the rows of the report as they are written, so
+# that the values can be saved alongside the formulas
+class FormulaValues:
+
+    SUMMED_COLUMNS = ['Ad server impressions', 'Ad server clicks']
+
+    def __init__(self, headers, first_row, first_column):
+        self.headers = headers
+        self.first_row = first_row
+        self.first_column = first_column
+        self.summed = [ column for column in FormulaValues.SUMMED_COLUMNS if column in headers ]
+        self.totals = dict((column, 0) for column in self.summed)
+        self.values = {}
+
+    def coordinate(self, row, column):
+        return '{}{}'.format(get_column_letter(self.first_column + self.headers.index(column)), row)
+
+    def record(self, row, sums):
+        for column, value in sums.items():
+            self.values[self.coordinate(row, column)] = value
+
+        # the CTR is the column to its left divided by the one left of that
+        if 'Ad server CTR' in self.headers and self.headers.index('Ad server CTR') >= 2:
+            index = self.headers.index('Ad server CTR')
+            clicks, impressions = sums.get(self.headers[index - 1]), sums.get(self.headers[index - 2])
+            if clicks is not None and impressions:
+                self.values[self.coordinate(row, 'Ad server CTR')] = clicks / float(impressions)
+
+    def track(self, rows):
+        """ Yields the `rows` of the report body (see report_rows) as they are,
+            noting the value of the formulas in the subtotal and total rows.
+        """
+        positions = [ self.headers.index(column) for column in self.summed ]
+        group = dict(self.totals)
+        for offset, (values, group_size) in enumerate(rows):
+            kind = TagIndex.kind_of(values[0]) if len(values) else None
+            if group_size:
+                group = dict((column, 0) for column in self.summed)
+
+            if kind is None:
+                for column, position in zip(self.summed, positions):
+                    value = values[position] if position < len(values) else None
+                    if is_number(value):
+                        group[column] += value
+                        self.totals[column] += value
+            elif kind == 'subtotal':
+                self.record(self.first_row + offset, group)
+            elif kind == 'total' and values[0] != '<total_bar>':
+                self.record(self.first_row + offset, self.totals)
+
+            yield values, group_size
+
+    def check(self, totals, output_path):
+        """ Whether the totals written to `output_path` match `totals` (the
+            sum of each column of the cleaned report), logging any that don't.
+        """
+        mismatches = [ column for column in self.summed if not numpy.isclose(self.totals[column], totals[column]) ]
+        for column in mismatches:
+            logging.error('The total {} written to "{}" ({}) does not match the report ({}).'.format(
+                column, output_path, self.totals[column], totals[column]))
+        return not mismatches
+
 
 def get_input_paths(inputs_dir):
     # read input file(s) from inputs directory
@@ -88,374 +175,833 @@ def get_input_paths(inputs_dir):
             and filename[0] != '.':
             yield file_path
 
-def initialise_workbook(template_path, output_path):
-    logging.debug('Copying template from "{0}" to "{1}"...'.format(template_path, output_path))
-
+# overwrite_policy is one of 'ask', 'always' or 'never'
+def confirm_overwrite(output_path, overwrite_policy = 'ask'):
     if (os.path.isfile(output_path)):
         print('File "{0}" already exists!'.format(output_path))
 
-        if query_yes_no('Do you want to proceed and overwrite this file?'):
+        if overwrite_policy == 'always' or \
+           (overwrite_policy == 'ask' and query_yes_no('Do you want to proceed and overwrite this file?')):
             logging.info('Overwriting "{0}"...'.format(output_path))
         else:
             logging.info('Not overwriting file; ignoring this report...')
-            return None
+            return False
     else:
         logging.debug('Creating report file  "{0}"...'.format(output_path))
 
-    shutil.copyfile(template_path, output_path)
-
-    # there is an annoying feature-missing log that gets output
-    logging.captureWarnings(True)
-    logging.disable(logging.ERROR)
-    workbook = openpyxl.load_workbook(filename = output_path)
-    logging.disable(logging.NOTSET)
-    return WrappedWorkbook(workbook = workbook, path = output_path)
+    return True
+
+def load_template(template_path, cache_directory = None):
+    """ Returns the layout of the template, or None if it does not hold all
+        the tags that the formatter writes to, so that a bad template fails
+        the run before any report is started.
+
+        :rtype: TemplateLayout
+    """
+    if not os.path.isfile(template_path):
+        logging.error('Template "{}" does not exist.'.format(template_path))
+        return None
+
+    layout = get_template_layout(template_path, cache_directory)
+    if not layout:
+        return None
+
+    missing = [ tag for tag in ['<order_id>', '<icon>'] if not layout.tag(tag) ]
+    if missing:
+        logging.error('Template "{}" is missing the tag(s): {}'.format(template_path, ', '.join(missing)))
+        return None
+
+    return layout
+
+# the template workbook loaded in this process, and the path and modification time it was loaded from
+template_workbook = {}
+
+def get_template_sheet(template_path):
+    """ Returns the worksheet of the template, loading it only if it hasn't
+        been loaded in this process yet (or has changed since).
+    """
+    key = (template_path, os.path.getmtime(template_path))
+    if template_workbook.get('key') != key:
+        logging.debug('Loading template "{}"...'.format(template_path))
+        template_workbook['key'], template_workbook['workbook'] = key, load_workbook(template_path)
+    return template_workbook['workbook'].active
+
+def initialise_workbook(template_path, output_path, confirmed = False, layout = None):
+    """ Copies the template, to be saved as `output_path` once it is formatted.
+        The template is loaded once in each process and its sheet copied for
+        each report (see exhelp.workbook_from_template), unless the version of
+        openpyxl is not the one the copy is made for. Given the template's
+        layout, the tags are indexed from the positions it holds rather than
+        found by scanning every cell.
+    """
+    logging.debug('Copying template "{0}" for "{1}"...'.format(template_path, output_path))
+
+    if not confirmed and not confirm_overwrite(output_path):
+        return None
+
+    if can_copy_template():
+        workbook = workbook_from_template(get_template_sheet(template_path))
+    else:
+        workbook = load_workbook(template_path)
+    tags = TagIndex.from_positions(workbook.active, layout.tags) if layout else None
+    return WrappedWorkbook(workbook = workbook, path = output_path, tags = tags)
+
+def add_report_sheet(workbook, template, title, output_path, layout = None):
+    """ Adds a copy of the `template` worksheet to the workbook, for one of
+        several reports to be written to it and saved together as `output_path`.
+    """
+    logging.debug('Adding sheet "{}" to "{}"...'.format(title, output_path))
+    worksheet = copy_template_sheet(workbook, template, title)
+    tags = TagIndex.from_positions(worksheet, layout.tags) if layout else None
+    return WrappedWorkbook(workbook = workbook, worksheet = worksheet, path = output_path, tags = tags)
+
+LINE_ITEM_ID_PATTERN = re.compile(r'^.*?(?P<line_item_id>ORD-\d+-\d+-\d+).*')
+ORDER_ID_PATTERN = re.compile(r'^.*?(?P<order_id>ORD-\d+).*')
 
 def extract_line_item_id(line_item_name):
-    line_item_id_pattern = r'.*?(?P<line_item_id>ORD-\d+-\d+-\d+).*'
-    matches = re.match(line_item_id_pattern, line_item_name)
+    matches = LINE_ITEM_ID_PATTERN.match(line_item_name)
     if matches:
         return matches.group('line_item_id')
 
 def extract_order_id(line_item_name):
-    order_id_pattern = r'.*?(?P<order_id>ORD-\d+).*'
-    matches = re.match(order_id_pattern, line_item_name)
+    matches = ORDER_ID_PATTERN.match(line_item_name)
     if matches:
         return matches.group('order_id')
 
+# the id of the group each line item belongs to, computed for the whole column at once
+def get_group_ids(df):
+    line_items = df['Line Item']
+    extracted_ids = (line_items.str.extract(LINE_ITEM_ID_PATTERN, expand = False)
+                               .fillna(line_items.str.extract(ORDER_ID_PATTERN, expand = False))
+                               .fillna('None'))
+
+    return (df['Line item start date'].astype(str) + '-' +
+            df['Line item end date'].astype(str) + '-' +
+            extracted_ids)
+
 # Line items are grouped if they have the same start/end date and line-item-id
 def group_line_items(df):
+    sorted_df = df.sort_values(by = ['Line item start date', 'Line Item', 'Creative Size'], inplace = False)
+    return sorted_df.groupby(by = get_group_ids(sorted_df), sort = True)
 
-    def get_group_id(index):
+# The values of the report as they are written, blanks as 'n/a', in a single
+# array; the blanks are filled a column at a time rather than checked cell by cell
+def report_values(df):
+    blanks = dict((column, 'n/a') for column in df.columns if df[column].dtype.kind in 'fO')
+    return df.fillna(blanks).astype(object).values
 
-        row = df.loc[index]
+# The rows of each group of line items, in the order group_line_items would
+# write them, as slices of one array of the whole report
+def report_groups(df):
+    if not len(df):
+        return iter([])
 
-        line_item_id = extract_line_item_id(row['Line Item'])
-        order_id = extract_order_id(row['Line Item'])
-        extracted_id = line_item_id if line_item_id else order_id
-        return '{}-{}-{}'.format(str(row['Line item start date']),
-                                 str(row['Line item end date']),
-                                 extracted_id)
+    sorted_df = df.sort_values(by = ['Line item start date', 'Line Item', 'Creative Size'], inplace = False)
+    group_ids = get_group_ids(sorted_df).values
 
-    return (df.sort_values(by = ['Line item start date', 'Line Item', 'Creative Size'], inplace = False)
-              .groupby(by = get_group_id, sort = True))
+    # a stable sort by group keeps the rows of each group in the order above
+    order = numpy.argsort(group_ids, kind = 'mergesort')
+    values, group_ids = report_values(sorted_df)[order], group_ids[order]
 
-def write_data(df, wrapped_workbook):
-    worksheet = wrapped_workbook.workbook.active
+    starts = numpy.flatnonzero(numpy.r_[True, group_ids[1:] != group_ids[:-1]])
+    stops = numpy.r_[starts[1:], len(group_ids)]
+    return ( values[start:stop] for start, stop in zip(starts, stops) )
 
-    # get the start and end tags
-    first_row_start = get_cell_by_regex(worksheet, '<data_start>')
-    first_row_end = get_cell_by_regex(worksheet, '<data_end>')
-    header_start = get_cell_by_regex(worksheet, '<header_start>')
+# Yields each row of the report body as (values, group_size), where group_size
+# is the size of the group of line items that starts on that row (0 otherwise)
+def report_rows(df):
+    return report_rows_for_groups(list(df.columns.values), report_groups(df))
 
-    if not all([first_row_start, first_row_end, header_start]):
-        return offer_clean_exit(wrapped_workbook.path)
+# As report_rows, for the rows of each group of line items in the order they
+# are written, with their blanks already filled (see report_values)
+def report_rows_for_groups(headers, groups):
 
-    # write the headers
-    headers = list(df.columns.values)
-    for column, header in enumerate(headers):
-        header_start.offset(column = column).value = header
-
-    total_row = [ Total.build_label(h) for h in headers ]
     blank_row = [None] * len(headers)
 
-    def replace_nan(row, replacement = 'n/a'):
-        return ['n/a' if type(cell) is float and numpy.isnan(cell) else cell for cell in row ]
-
-    rows_to_write = []
-    for _, line_items in group_line_items(df):
+    last_row_blank = None
+    for rows in groups:
 
-        group_size = len(line_items)
+        group_size = len(rows)
 
         # provide a new line above groups (if they aren't the first row and there isn't already one)
-        if rows_to_write and group_size > 1 and rows_to_write[-1] != blank_row:
-            rows_to_write.append(blank_row)
+        if last_row_blank is False and group_size > 1:
+            yield blank_row, 0
 
         # write each row of each group
-        rows = dataframe_to_rows(line_items, index = False, header = False)
-        for row in rows:
-            rows_to_write.append(replace_nan(row))
+        for index, row in enumerate(rows):
+            yield row, (group_size if index == 0 else 0)
+        last_row_blank = False
 
         # if we have more than one line in a group, write a subtotal row
         if group_size > 1:
-            subtotal_row = [ SubTotal.build_label(group_size, h) for h in headers ]
-            rows_to_write.append(subtotal_row)
-            rows_to_write.append(blank_row)
+            yield [ SubTotal.build_label(group_size, h) for h in headers ], 0
+            yield blank_row, 0
+            last_row_blank = True
 
     # add a blank row after all the data has been written, then add a total row
-    rows_to_write.append(blank_row)
-    rows_to_write.append(total_row)
+    yield blank_row, 0
+    yield [ Total.build_label(h) for h in headers ], 0
 
     # add a row for the total border
-    rows_to_write.append([ '<total_bar>' for h in headers] )
+    yield [ '<total_bar>' for h in headers ], 0
 
-    # now write them to the worksheet
-    for row, values in enumerate(rows_to_write):
-        for column, value in enumerate(values):
-            first_row_start.offset(row = row, column = column).value = value
+def write_data(df, wrapped_workbook):
+    tags = wrapped_workbook.tags
+
+    # get the start and end tags
+    first_row_start = tags.cell('<data_start>')
+    first_row_end = tags.cell('<data_end>')
+    header_start = tags.cell('<header_start>')
+
+    if not all([first_row_start, first_row_end, header_start]):
+        return offer_clean_exit(wrapped_workbook.path)
+
+    # write the headers
+    headers = list(df.columns.values)
+    for column, header in enumerate(headers):
+        tags.set_value(header_start.offset(column = column), header)
+
+    # now write each row to the worksheet, noting where each group starts; only
+    # the cells that hold a tag, before or after, are written through the index
+    worksheet = wrapped_workbook.worksheet
+    tagged = tags.positions()
+    groups = []
+    formula_values = FormulaValues(headers, first_row_start.row, first_row_start.col_idx)
+    for row, (values, group_size) in enumerate(formula_values.track(report_rows(df))):
+        if group_size:
+            groups.append(GroupSpan(first_row = first_row_start.row + row, size = group_size))
+        for column, value in enumerate(values, first_row_start.col_idx):
+            position = (first_row_start.row + row, column)
+            if position in tagged or TagIndex.kind_of(value) is not None:
+                tags.set_value(worksheet.cell(row = position[0], column = column), value)
+            else:
+                worksheet.cell(row = position[0], column = column).value = value
 
     return WrappedWorkbook(workbook = wrapped_workbook.workbook,
+                           worksheet = wrapped_workbook.worksheet,
                            path = wrapped_workbook.path,
                            start_marker = first_row_start,
-                           end_marker = first_row_end.offset(row = len(rows_to_write) - 1))
+                           end_marker = first_row_end.offset(row = row),
+                           tags = tags,
+                           groups = groups,
+                           headers = headers,
+                           formula_values = formula_values)
 
 def apply_styling(wrapped_workbook, image_path, columns_to_merge = []):
 
     logging.debug('Applying styling...')
 
-    worksheet = wrapped_workbook.workbook.active
+    worksheet = wrapped_workbook.worksheet
+    tags = wrapped_workbook.tags
     data_start, data_end = wrapped_workbook.start_marker, wrapped_workbook.end_marker
 
-    # copy the styles down each column
-    for column in worksheet.iter_cols(min_col = data_start.col_idx,
-                                      max_col = data_end.col_idx,
-                                      min_row = data_start.row,
-                                      max_row = data_end.row):
-
-        # use the first cell in each column as a format for the rest
-        template = column[0]
-        for cell in column:
-            cell.font = copy(template.font)
-            cell.alignment = copy(template.alignment)
-            if template.is_date:
-                cell.number_format = 'dd/mm/yyyy'
-            else:
-                cell.number_format = copy(template.number_format)
-
-    # embolden all of the tags
-    for tag in get_cells_by_regex(worksheet, r'^<[\w\s]+>$'):
-        tag.font = update_font(tag.font, {'bold': True})
-
-        # specifically format the total bar
-        if tag.value == r'<total_bar>':
-            tag.value = None
-            tag.fill = PatternFill(patternType = 'solid',
-                                   fgColor = 'F2F2F2')
+    # every cell shares one of a handful of styles: one per column, border
+    # position and kind of row; each is registered with the workbook once
+    borders = BorderCache()
+    styles = StyleCache()
+
+    # merge the rows within groups for the columns specified, straight from the groups that write_data wrote
+    headers = wrapped_workbook.headers
+    merge_columns = [ data_start.col_idx + headers.index(c) for c in columns_to_merge if c in headers ]
+    merge_ranges(worksheet, [ (group.first_row, column, group.last_row, column)
+                              for group in wrapped_workbook.groups if group.size > 1
+                              for column in merge_columns ])
+
+    # use the first cell in each column as a format for the rest
+    column_styles = []
+    for template in worksheet.iter_cols(min_col = data_start.col_idx,
+                                        max_col = data_end.col_idx,
+                                        min_row = data_start.row,
+                                        max_row = data_start.row):
+        template = template[0]
+        column_styles.append((copy(template.font),
+                              update_font(template.font, {'bold': True}),
+                              copy(template.alignment),
+                              'dd/mm/yyyy' if template.is_date else template.number_format))
+
+    # style and border the data block, emboldening the tags and formatting the total bar
+    total_bar_fill = PatternFill(patternType = 'solid', fgColor = 'F2F2F2')
+    for row in worksheet.iter_rows(min_col = data_start.col_idx,
+                                   max_col = data_end.col_idx,
+                                   min_row = data_start.row,
+                                   max_row = data_end.row):
+        for index, cell in enumerate(row):
+            font, bold_font, alignment, number_format = column_styles[index]
+            edges = borders.edges(data_start, data_end, cell)
+            is_tag = TagIndex.kind_of(cell.value) is not None
+            is_total_bar = cell.value == r'<total_bar>'
+
+            extra_styles = {'fill': total_bar_fill} if is_total_bar else {}
+            styles.apply(cell, ('data', index, is_tag, is_total_bar) + edges,
+                         font = bold_font if is_tag else font,
+                         alignment = alignment,
+                         number_format = number_format,
+                         border = borders.get(*edges),
+                         **extra_styles)
+
+            if is_total_bar:
+                tags.set_value(cell, None)
+
+    # embolden the rest of the tags
+    for tag in tags.all_cells():
+        if not (data_start.row <= tag.row <= data_end.row and data_start.col_idx <= tag.col_idx <= data_end.col_idx):
+            tag.font = update_font(tag.font, {'bold': True})
 
     # add the picture and limit the size
     img = Image(image_path, coordinates = ((0,0), (1,1)), size = (80, 80))
-    worksheet.add_image(img, get_cell_by_regex(worksheet, r'<icon>').coordinate)
-
-    # merge the rows within groups for the columns specified
-    all_subtotals = [ SubTotal.from_cell(cell) for cell in get_cells_by_regex(worksheet, SubTotal.EXTRACTION_PATTERN) ]
-    subtotals_for_merging = [ subtotal for subtotal in all_subtotals if subtotal.group_type in columns_to_merge ]
-
-    def get_range(from_first, to_last):
-        return '{}:{}'.format(from_first.coordinate, to_last.coordinate)
-        worksheet.merge_cells(merge_range)
-
-    for subtotal in subtotals_for_merging:
-        group = sorted(subtotal.cells_above_in_group(), key = lambda c: c.coordinate)
-        worksheet.merge_cells(get_range(group[0], group[-1]))
+    worksheet.add_image(img, tags.cell('<icon>').coordinate)
 
     # merge the order_id cells
-    order_id_start = get_cell_by_regex(worksheet, r'<order_id>')
+    order_id_start = tags.cell('<order_id>')
     order_id_end = worksheet.cell(row = data_end.row, column = order_id_start.col_idx)
     order_id_range = get_range(order_id_start, order_id_end)
     worksheet.merge_cells(order_id_range)
 
     # add a border to the order_id block
+    order_id_alignment = Alignment(horizontal = 'center',
+                                   vertical = 'center',
+                                   textRotation = 90)
     for row in worksheet[order_id_range]:
         for cell in row:
-            cell.border = get_border(top_left = order_id_start,
-                                     bottom_right = order_id_end,
-                                     cell = cell)
-            cell.alignment = Alignment(horizontal = 'center',
-                                       vertical = 'center',
-                                       textRotation = 90)
-
-    # add a border to the data block
-    for row in worksheet['{}:{}'.format(data_start.coordinate, data_end.coordinate)]:
-        for cell in row:
-            cell.border = get_border(top_left = data_start,
-                                     bottom_right = data_end,
-                                     cell = cell)
+            edges = borders.edges(order_id_start, order_id_end, cell)
+            styles.apply(cell, ('order_id',) + edges,
+                         border = borders.get(*edges),
+                         alignment = order_id_alignment)
 
     return wrapped_workbook
 
+# Returns the value that replaces a subtotal or total tag in `column` (index)
+# of `row`, adding up the rows from `first_row` to the row above; None means
+# the tag is left to be removed with the other extra tags
+def get_total_value(group_type, column, row, first_row, label):
+    if group_type == 'Ad server CTR':
+        return '={0}{2}/{1}{2}'.format(get_column_letter(column - 1), get_column_letter(column - 2), row)
+    elif group_type == 'Delivery Indicator':
+        return label
+    elif group_type in ['Ad server clicks', 'Ad server impressions']:
+        return get_column_subtotal_formula(get_column_letter(column), first_row, row - 1)
+
 def write_totals(wrapped_workbook):
 
     # open up the workbook
-    worksheet = wrapped_workbook.workbook.active
-    data_start = wrapped_workbook.start_marker
-    data_end = wrapped_workbook.end_marker
+    tags = wrapped_workbook.tags
 
     # replace the totals first; subtotalled rows need not be counted twice
-    total_cells = [ c for c in get_cells_by_regex(worksheet, Total.EXTRACTION_PATTERN) ]
-    subtotal_cells = [ c for c in get_cells_by_regex(worksheet, SubTotal.EXTRACTION_PATTERN) ]
-
-    def identify_non_subtotalled_cells(candidates, subtotal_cells):
+    total_cells = tags.cells_of_kind('total')
+    subtotal_cells = tags.cells_of_kind('subtotal')
 
-        # determine which cells are covered by subtotals (including the subtotals themselves)
-        subtotalled_cells = []
-        for subtotal_cell in subtotal_cells:
-            subtotal = SubTotal.from_cell(subtotal_cell)
-            for i in range(0, subtotal.group_size + 1, 1):
-                subtotalled_cells.append(subtotal_cell.offset(row = -i))
-
-        # any cells not caught (and non blank) need to be captured
-        return [ c for c in candidates if c not in (subtotalled_cells + subtotal_cells) and c.value ]
+    # subtotals are written as SUBTOTAL formulas, which a total spanning the
+    # whole data block skips; this keeps the total formula the same length
+    # however many line items the report has
+    data_start = wrapped_workbook.start_marker
 
     for cell in total_cells:
         total = Total.from_cell(cell)
-        if total.group_type == 'Ad server CTR':
-            total.cell.value = '={}/{}'.format(total.cell.offset(column = -1).coordinate,
-                                              total.cell.offset(column = -2).coordinate)
-        elif total.group_type == 'Delivery Indicator':
-            total.cell.value = 'TOTAL'
-
-        elif total.group_type in ['Ad server clicks', 'Ad server impressions']:
-            column_above = [ c for c in cells_between(data_start, total.cell.offset(row = - 1)) if c.column == total.cell.column ]
-            subtotals_above = [ s for s in subtotal_cells if s in column_above ]
-
-            non_subtotalled_cells = identify_non_subtotalled_cells(column_above, subtotals_above)
-            total.cell.value = get_add_formula(subtotals_above + non_subtotalled_cells)
+        value = get_total_value(total.group_type, cell.col_idx, cell.row, data_start.row, 'TOTAL')
+        if value is not None:
+            tags.set_value(cell, value)
 
     for cell in subtotal_cells:
         subtotal = SubTotal.from_cell(cell)
-
-        if subtotal.group_type == 'Ad server CTR':
-            subtotal.cell.value = '={}/{}'.format(subtotal.cell.offset(column = -1).coordinate,
-                                              subtotal.cell.offset(column = -2).coordinate)
-        elif subtotal.group_type == 'Delivery Indicator':
-            subtotal.cell.value = 'Total'
-
-        elif subtotal.group_type in ['Ad server clicks', 'Ad server impressions']:
-            group = subtotal.cells_above_in_group()
-            subtotal.cell.value = get_sum_formula(group[0], group[-1])
+        first_row, _ = subtotal.rows_in_group()
+        value = get_total_value(subtotal.group_type, cell.col_idx, cell.row, first_row, 'Total')
+        if value is not None:
+            tags.set_value(cell, value)
 
     return wrapped_workbook
 
 def replace_order_id(wrapped_workbook, order_id):
-    worksheet = wrapped_workbook.workbook.active
-    order_id_cell = get_cell_by_regex(worksheet, r'<order_id>')
-    order_id_cell.value = order_id
+    tags = wrapped_workbook.tags
+    tags.set_value(tags.cell('<order_id>'), order_id)
 
     return wrapped_workbook
 
 def remove_extra_tags(wrapped_workbook):
-    for tag in get_cells_by_regex(wrapped_workbook.workbook.active, r'^<[\w\s]+>$'):
-        tag.value = None
+    tags = wrapped_workbook.tags
+    for tag in tags.all_cells():
+        tags.set_value(tag, None)
 
     return wrapped_workbook
 
 def save_workbook(wrapped_workbook):
     wrapped_workbook.workbook.save(wrapped_workbook.path)
+
+    # openpyxl saves formulas without their values, which are filled in afterwards
+    if wrapped_workbook.formula_values:
+        fill_formula_values(wrapped_workbook.path, {wrapped_workbook.worksheet.path[1:]: wrapped_workbook.formula_values.values})
     return wrapped_workbook
 
-def main():
-
-    report_columns = ['Line Item',
-                      'Creative',
-                      'Delivery Indicator',
-                      'Line item start date',
-                      'Line item end date',
-                      'Goal quantity',
-                      'Creative Size',
-                      'DAP Native Format',
-                      'Ad server impressions',
-                      'Ad server clicks',
-                      'Ad server CTR'
-                      ]
-
-    report_columns_trimmed_and_ordered = ['Line Item',
-                                          'Line item start date',
-                                          'Line item end date',
-                                          'Goal quantity',
-                                          'Creative Size',
-                                          'Delivery Indicator',
-                                          'Ad server impressions',
-                                          'Ad server clicks',
-                                          'Ad server CTR']
-
-    columns_to_merge = ['Delivery Indicator',
-                        'Line item start date',
-                        'Line item end date',
-                        'Goal quantity']
-
-    inputs = {
-        'Sheet Name'              : 'Report data',
-        'Inputs Directory'        : 'inputs',
-        'Outputs Directory'       : 'outputs',
-        'Template'                : os.path.join('assets','template.xlsx'),
-        'Icon'                    : os.path.join('assets','icon.png'),
-        'Goal Quantity Threshold' : 1000,
-        'Required Columns'        : ', '.join(report_columns)
-    }
-
-    validators = [partial(validate_column_names, required_columns = report_columns)]
-    cleaners = [partial(drop_row_with_value_in_column, column_name = 'Line Item',
-                                                       value = 'Total',
-                                                       exact_match = True),
-                partial(drop_row_with_value_in_column, column_name ='Line Item',
-                                                       value = 'TEST',
-                                                       exact_match = False),
-                partial(replace_value_below_threshold_with_nan, column_name = 'Goal quantity',
-                                                                threshold = inputs['Goal Quantity Threshold']),
-                partial(replace_column_value, column_name = 'Creative Size',
-                                              pattern = '1 x 1',
-                                              replacement = 'pageskin'),
-                partial(replace_column_extract, column_name = 'Creative Size',
-                                              extract_value_from_row = lambda row: row['DAP Native Format'] if row['Creative Size'] == 'Native' and row['DAP Native Format'] != '-' else row['Creative Size']),
-              partial(drop_columns_not_required, required_columns = report_columns_trimmed_and_ordered),
-                partial(replace_datetime_with_date, column_name = 'Line item start date'),
-                partial(replace_datetime_with_date, column_name = 'Line item end date'),
-                partial(reorder_columns, ordered_columns = report_columns_trimmed_and_ordered)]
+# reports are always written as .xlsx workbooks, whatever the format of the input
+def get_output_path(input_path, outputs_dir, order_id = None):
+    stem = os.path.splitext(os.path.basename(input_path))[0]
+    if order_id:
+        stem = '{}_{}'.format(stem, order_id)
+    return os.path.join(outputs_dir, 'formatted_{}.xlsx'.format(stem))
+
+# in sheets output mode, every report is a sheet of this workbook
+def get_sheets_output_path(outputs_dir):
+    return os.path.join(outputs_dir, 'formatted_reports.xlsx')
+
+# the rows of each order in the report, found for the whole column at once
+def split_by_order(df):
+    order_ids = df['Line Item'].str.extract(ORDER_ID_PATTERN, expand = False)
+
+    missing = order_ids.isnull()
+    if missing.any():
+        audit_rows(df[missing], 'split_by_order', 'Removing', 'no order id in "Line Item"')
+
+    return [ (order_id, rows) for order_id, rows in df.groupby(order_ids, sort = True) ]
+
+def format_report(input_path, inputs, reader, validators, cleaners, columns_to_merge, template_layout = None):
+    """ Formats a single input report, from reading it through to saving the
+        output workbook (or, with 'Split Orders' set, a workbook for each order
+        in it). The output path must already have been confirmed, as this may
+        run in a worker process that cannot ask any questions.
+
+        :param reader: reads the input report into a dataframe (see readers.read_report),
+            or into chunks of one in chunked output mode (see chunked.py)
+        :param template_layout: the parsed template (see load_template)
+
+        :return: the summary of each report written; none if it was skipped
+        :rtype: list
+    """
+    if inputs['Output Mode'] == 'chunked':
+        from chunked import format_report_in_chunks
+        if inputs['Split Orders']:
+            logging.warning('Orders are not split in chunked mode; "{}" is formatted as a single report.'.format(input_path))
+        summary = format_report_in_chunks(input_path, inputs, reader, validators, cleaners, columns_to_merge, template_layout)
+        return [summary] if summary else []
+
+    profiler = Profiler(trace_memory = inputs['Trace Memory'])
+    report = read_and_clean(input_path, reader, validators, cleaners, profiler, build_audit_log(input_path, inputs),
+                            inputs['Split Orders'])
+    if report is None:
+        return []
+    df_raw, df_clean, orders = report
+
+    if inputs['Split Orders']:
+        logging.info('Read, cleaned and split "{}" into {} orders in {:.3f}s.'.format(input_path, len(orders), profiler.total_seconds))
+        return format_orders(input_path, orders, inputs, columns_to_merge, template_layout)
+
+    output_path = get_output_path(input_path, inputs['Outputs Directory'])
+    order_id = extract_order_id(df_raw['Line Item'][0])
+
+    summary = write_report(df_clean, input_path, output_path, order_id, inputs, columns_to_merge, template_layout, profiler)
+    return [summary] if summary else []
+
+def build_audit_log(input_path, inputs, dry_run = False):
+    """ Returns the log of the rows that cleaning `input_path` drops or changes, kept alongside its report
+
+        :param dry_run: log to a file of its own (e.g. formatted_x.dryrun.audit.csv), leaving that of the last run be
+    """
+    stem = os.path.splitext(get_output_path(input_path, inputs['Outputs Directory']))[0] + ('.dryrun' if dry_run else '')
+    return AuditLog(stem + '.audit.' + inputs['Audit'], inputs['Audit'], inputs['Audit Detail'], inputs['Audit Row Cap'],
+                    dry_run = dry_run)
+
+def read_and_clean(input_path, reader, validators, cleaners, profiler, audit_log, split_orders = False):
+    """ Returns the raw and the cleaned input report, along with its orders
+        (see split_by_order) if `split_orders` is set, or None if it is invalid
+
+        :param audit_log: the log of the rows that cleaning (or splitting) drops or changes (see build_audit_log)
+    """
+    df_raw = profiler.run('read', reader, input_path)
+
+    # if the input is invalid (or didn't fit the reader's schema) then skip it
+    if df_raw is None or not all([ profiler.call(df_raw, validator) for validator in validators ]):
+        logging.error('Input report "{}" is invalid; report will be skipped.'.format(input_path))
+        return None
+
+    logging.info('\nCleaning data for "{}"...'.format(input_path))
+    with audit_log:
+        df_clean, _ = CleanerPlan(cleaners).execute(df_raw, run = profiler.run)
+        orders = profiler.run('split_by_order', split_by_order, df_clean) if split_orders else None
+    return df_raw, df_clean, orders
+
+# the steps that write a report to a worksheet copied from the template; each returns a WrappedWorkbook or None
+def formatting_steps(df_clean, order_id, image_path, columns_to_merge):
+    return [partial(write_data, df_clean),
+            partial(apply_styling, image_path = image_path, columns_to_merge = columns_to_merge),
+            write_totals,
+            partial(replace_order_id, order_id = order_id),
+            remove_extra_tags]
+
+def report_summary(df_clean, input_path, output_path, order_id, inputs, profiler, sheet = None, formula_values = None):
+    """ Returns the summary of a report written to `output_path` (as `sheet` of it, if given),
+        writing its metrics alongside it.
+
+        :param formula_values: the values saved alongside the report's formulas, whose totals
+            are checked against those of the report
+    """
+    summary = [('Input Report', input_path),
+               ('Report Name', os.path.basename(output_path))]
+    if sheet:
+        summary.append(('Sheet', sheet))
+    summary.extend([('Order ID', order_id),
+                    ('Total Ad server impressions', df_clean['Ad server impressions'].sum()),
+                    ('Total Ad server clicks', df_clean['Ad server clicks'].sum())])
+    if formula_values is not None:
+        summary.append(('Saved Totals', 'match' if formula_values.check(df_clean[formula_values.summed].sum(), output_path) else 'DO NOT MATCH'))
+
+    if inputs['Metrics'] in ['json', 'csv']:
+        name = os.path.splitext(output_path)[0] + ('.' + sheet if sheet else '')
+        summary.append(('Metrics', profiler.write(name + '.metrics.' + inputs['Metrics'], inputs['Metrics'])))
+
+    return summary + profiler.summary()
+
+def write_report(df_clean, input_path, output_path, order_id, inputs, columns_to_merge, template_layout = None, profiler = None):
+    """ Writes the formatted report of the cleaned `df_clean` to `output_path`
+
+        :param profiler: the profiler that timed reading and cleaning the report, if any
+
+        :return: the summary of the report, or None if it was skipped
+        :rtype: list
+    """
+    profiler = profiler or Profiler(trace_memory = inputs['Trace Memory'])
+
+    if inputs['Output Mode'] == 'streaming':
+        from streamer import stream_report
+        formula_values = profiler.run('stream_report', partial(stream_report, layout = template_layout,
+                                                                              output_path = output_path,
+                                                                              image_path = inputs['Icon'],
+                                                                              order_id = order_id,
+                                                                              columns_to_merge = columns_to_merge), df_clean)
+    else:
+        wrapped_workbook = format_workbook(df_clean, output_path, order_id, inputs, columns_to_merge, template_layout, profiler)
+        if not wrapped_workbook or not profiler.bind(wrapped_workbook, save_workbook):
+            return None
+        formula_values = wrapped_workbook.formula_values
+
+    logging.info('Workbook "{}" formatting complete!\n'.format(output_path))
+    return report_summary(df_clean, input_path, output_path, order_id, inputs, profiler, formula_values = formula_values)
+
+def format_workbook(df_clean, output_path, order_id, inputs, columns_to_merge, template_layout, profiler):
+    """ Formats the report of `df_clean` in a copy of the template, ready to be saved to `output_path`
+
+        :return: the formatted workbook, or None if formatting failed
+        :rtype: WrappedWorkbook
+    """
+    wrapped_workbook = initialise_workbook(template_path = inputs['Template'],
+                                           output_path = output_path,
+                                           confirmed = True,
+                                           layout = template_layout)
+
+    transformations = formatting_steps(df_clean, order_id, inputs['Icon'], columns_to_merge)
+    return reduce(profiler.bind, transformations, wrapped_workbook)
+
+def format_orders(input_path, orders, inputs, columns_to_merge, template_layout = None):
+    """ Writes a formatted report for each (order id, cleaned rows) in
+        `orders`, across a pool of inputs['Workers'] processes if there is more
+        than one. Runs in the main process, so that it can ask before
+        overwriting the report of an order.
+
+        :return: the summary of each report written
+        :rtype: list
+    """
+    reports = []
+    for order_id, df_order in orders:
+        output_path = get_output_path(input_path, inputs['Outputs Directory'], order_id)
+        if confirm_overwrite(output_path, inputs['Overwrite']):
+            reports.append((df_order, output_path, order_id))
+
+    write = partial(write_report, input_path = input_path,
+                                  inputs = inputs,
+                                  columns_to_merge = columns_to_merge,
+                                  template_layout = template_layout)
+
+    if inputs['Workers'] <= 1 or len(reports) <= 1:
+        return [ summary for summary in (write(df, output_path = path, order_id = order_id) for df, path, order_id in reports) if summary ]
+
+    logging.info('Writing {} orders across {} worker processes...'.format(len(reports), inputs['Workers']))
+
+    summaries = []
+    with ProcessPoolExecutor(max_workers = inputs['Workers']) as executor:
+        futures = [ executor.submit(write, df, output_path = path, order_id = order_id) for df, path, order_id in reports ]
+        for (_, output_path, _), future in zip(reports, futures):
+            try:
+                summary = future.result()
+            except Exception:
+                logging.exception('Writing "{}" failed; report will be skipped.'.format(output_path))
+                continue
+            if summary:
+                summaries.append(summary)
+
+    return summaries
+
+def dry_run_report(input_path, reader, validators, cleaners, audit_log):
+    """ Reads, validates and cleans an input report, logging what each
+        cleaner changes, without formatting it.
+
+        :param audit_log: the log of the rows that cleaning drops or changes (see build_audit_log)
+    """
+    df_raw = reader(input_path)
+    if df_raw is None or not all([ validator(df_raw) for validator in validators ]):
+        logging.error('Input report "{}" is invalid; it would be skipped.'.format(input_path))
+        return
+
+    logging.info('\nCleaning data for "{}"...'.format(input_path))
+    with audit_log:
+        df_clean, changes = CleanerPlan(cleaners).execute(df_raw, dry_run = True)
+
+    log_divider()
+    logging.info('Cleaning "{}" would leave {} of {} row(s):'.format(input_path, len(df_clean), len(df_raw)))
+    for cleaner, change in changes:
+        logging.info('\t{:40s}: {}'.format(cleaner, change))
+    log_divider()
+
+def format_reports_as_sheets(input_paths, inputs, reader, validators, cleaners, columns_to_merge, template_layout = None):
+    """ Formats every input report (or, with 'Split Orders' set, every order
+        in them) as a sheet of a single workbook, each a copy of the template's
+        sheet, so that the whole batch is written with one load and one save.
+
+        :return: the summary of each report written
+        :rtype: list
+    """
+    output_path = get_sheets_output_path(inputs['Outputs Directory'])
+    workbook = load_workbook(inputs['Template'])
+    template = workbook.active
+
+    summaries, formatted_sheets = [], []
+    for input_path in input_paths:
+        profiler = Profiler(trace_memory = inputs['Trace Memory'])
+        report = read_and_clean(input_path, reader, validators, cleaners, profiler, build_audit_log(input_path, inputs),
+                                inputs['Split Orders'])
+        if report is None:
+            continue
+        df_raw, df_clean, orders = report
+
+        if not inputs['Split Orders']:
+            orders = [(extract_order_id(df_raw['Line Item'][0]), df_clean)]
+
+        for order_id, df_order in orders:
+            title = order_id if inputs['Split Orders'] else os.path.splitext(os.path.basename(input_path))[0]
+            wrapped_workbook = add_report_sheet(workbook, template, title, output_path, template_layout)
+
+            transformations = formatting_steps(df_order, order_id, inputs['Icon'], columns_to_merge)
+            formatted = reduce(profiler.bind, transformations, wrapped_workbook)
+            if formatted:
+                formatted_sheets.append(formatted)
+                summaries.append(report_summary(df_order, input_path, output_path, order_id, inputs, profiler,
+                                                sheet = formatted.worksheet.title,
+                                                formula_values = formatted.formula_values))
+
+            # the next sheet's metrics start afresh
+            profiler = Profiler(trace_memory = inputs['Trace Memory'])
+
+    if not summaries:
+        return []
+
+    workbook.remove(template)
+    profiler.run('save_workbook', save_workbook, WrappedWorkbook(workbook = workbook, path = output_path))
+
+    # each sheet's part name is only known once the workbook is saved
+    profiler.run('fill_formula_values', partial(fill_formula_values, values_by_sheet = dict(
+        (formatted.worksheet.path[1:], formatted.formula_values.values) for formatted in formatted_sheets)), output_path)
+    logging.info('Workbook "{}" of {} sheets saved in {:.3f}s.\n'.format(output_path, len(summaries), profiler.total_seconds))
+    return summaries
+
+def format_reports(input_paths, workers = 1, **kwargs):
+    """ Formats each of the input reports, across a pool of `workers`
+        processes if there is more than one, and returns their summaries in
+        the order of `input_paths`. Reports that fail or are skipped have no
+        summary. When orders are split, the inputs are read one at a time and
+        their orders written across the pool instead.
+
+        Inputs formatted one at a time are pipelined (see pipeline.py), so that
+        the next input is read while the last report is saved.
+
+        :param kwargs: passed on to format_report
+    """
+    if kwargs['inputs']['Output Mode'] == 'sheets':
+        return format_reports_as_sheets(input_paths, **kwargs)
+
+    if workers <= 1 or len(input_paths) <= 1 or kwargs['inputs']['Split Orders']:
+        # chunked reports are read as they are written, so there's nothing to read ahead
+        if kwargs['inputs']['Prefetch'] > 0 and len(input_paths) > 1 and kwargs['inputs']['Output Mode'] != 'chunked':
+            from pipeline import format_reports_pipelined
+            return format_reports_pipelined(input_paths, **kwargs)
+        return [ summary for path in input_paths for summary in format_report(path, **kwargs) ]
+
+    logging.info('Formatting {} reports across {} worker processes...'.format(len(input_paths), workers))
+
+    summaries = []
+    with ProcessPoolExecutor(max_workers = workers) as executor:
+        futures = [ executor.submit(format_report, path, **kwargs) for path in input_paths ]
+        for input_path, future in zip(input_paths, futures):
+            try:
+                summaries.extend(future.result())
+            except Exception:
+                logging.exception('Formatting "{}" failed; report will be skipped.'.format(input_path))
+
+    return summaries
+
+def log_summary(summary):
+    for prop, value in summary:
+        logging.info('{:30s}: "{}"'.format(prop, value))
+    log_divider()
+    logging.info('')
+
+def parse_arguments(argv = None):
+    parser = argparse.ArgumentParser(description = 'Formats DFP report exports using a template workbook.')
+    parser.add_argument('-c', '--config',
+                        help = 'a JSON (or, with PyYAML installed, YAML) file of settings to override the defaults')
+    parser.add_argument('-y', '--yes', action = 'store_true',
+                        help = 'format every input and overwrite existing outputs without asking, then exit')
+    parser.add_argument('--dry-run', action = 'store_true',
+                        help = 'report what cleaning each input would change, without formatting any of them')
+    parser.add_argument('--watch', action = 'store_true',
+                        help = 'keep running, formatting each input as it arrives in (or changes within) the inputs directory, '
+                               'and overwriting existing outputs unless --no-overwrite is given')
+    parser.add_argument('--rebuild', action = 'store_true',
+                        help = 'format every input, even those unchanged since their output was built')
+    overwrite = parser.add_mutually_exclusive_group()
+    overwrite.add_argument('--overwrite', dest = 'overwrite_policy', action = 'store_const', const = 'always',
+                           help = 'overwrite existing outputs without asking')
+    overwrite.add_argument('--no-overwrite', dest = 'overwrite_policy', action = 'store_const', const = 'never',
+                           help = 'skip any input whose output already exists')
+    parser.add_argument('--inputs', help = 'the directory of reports to format')
+    parser.add_argument('--outputs', help = 'the directory to write formatted reports to')
+    parser.add_argument('--template', help = 'the template workbook')
+    parser.add_argument('--mode', choices = ['workbook', 'sheets', 'streaming', 'chunked'],
+                        help = 'the output engine; sheets writes every report to a sheet of one workbook, '
+                               'and chunked streams reports too large to hold in memory')
+    parser.add_argument('--memory-budget', type = int,
+                        help = 'the memory (in MB) to format each report within, in chunked mode')
+    parser.add_argument('--split-orders', action = 'store_true', default = None,
+                        help = 'write a separate report for each order in an input')
+    parser.add_argument('--workers', type = int, help = 'the number of reports to format at once')
+    parser.add_argument('--prefetch', type = int,
+                        help = 'the number of inputs to read ahead (and outputs to save behind) of the report being formatted; '
+                               '0 formats one report at a time')
+    parser.add_argument('--metrics', choices = ['json', 'csv', 'none'],
+                        help = 'the format of the per-stage timings written alongside each report')
+    parser.add_argument('--audit', choices = AuditLog.FORMATS,
+                        help = 'the format of the rows each cleaner drops or changes, written alongside each report')
+    parser.add_argument('--trace-memory', action = 'store_true', default = None,
+                        help = 'record the peak memory allocated by each stage (slow)')
+
+    arguments = parser.parse_args(argv)
+    if arguments.overwrite_policy is None:
+        arguments.overwrite_policy = 'always' if arguments.yes or arguments.watch else 'ask'
+    return arguments
+
+def main(argv = None):
+
+    arguments = parse_arguments(argv)
+    config = load_config(arguments.config)
+
+    # the command line takes precedence over the config file
+    for setting, value in [('Inputs Directory', arguments.inputs),
+                           ('Outputs Directory', arguments.outputs),
+                           ('Template', arguments.template),
+                           ('Output Mode', arguments.mode),
+                           ('Split Orders', arguments.split_orders),
+                           ('Workers', arguments.workers),
+                           ('Prefetch', arguments.prefetch),
+                           ('Memory Budget', arguments.memory_budget),
+                           ('Metrics', arguments.metrics),
+                           ('Audit', arguments.audit),
+                           ('Trace Memory', arguments.trace_memory)]:
+        if value is not None:
+            config[setting] = value
+
+    inputs = dict((setting, value) for setting, value in config.items()
+                  if setting not in ['Required Columns', 'Report Columns', 'Columns To Merge', 'Date Columns', 'Text Columns', 'Cleaners'])
+    inputs['Required Columns'] = ', '.join(config['Required Columns'])
+    inputs['Cleaners'] = ', '.join([ spec.get('cleaner') for spec in config['Cleaners'] ])
+    inputs['Overwrite'] = arguments.overwrite_policy
+
+    columns_to_merge = config['Columns To Merge']
+    reader = build_chunk_reader(config) if config['Output Mode'] == 'chunked' else build_reader(config)
+    validators = [partial(validate_column_names, required_columns = config['Required Columns'])]
+    cleaners = build_cleaners(config)
 
     log_divider(symbol = '*')
     logging.info('Running the report formatter with the following inputs:')
     for prop, value in inputs.items(): logging.info('\t{:25s}: {}'.format(prop, value))
     log_divider(symbol = '*')
 
-    summaries = []
-    for input_path in get_input_paths(inputs['Inputs Directory']):
-
-        logging.info('Found input "{}" '.format(input_path))
-        if not query_yes_no('Want to format this report?'):
-            logging.info('Okay, looking for other inputs...')
-            continue
+    if arguments.dry_run:
+        logging.info('The cleaners will run as:')
+        for line in CleanerPlan(cleaners).describe(): logging.info('\t{}'.format(line))
+        for input_path in get_input_paths(inputs['Inputs Directory']):
+            dry_run_report(input_path, build_reader(config), validators, cleaners, build_audit_log(input_path, inputs, dry_run = True))
+        return 0
 
-        df_raw = pandas.read_excel(io = input_path, sheetname = inputs['Sheet Name'])
+    # the template is parsed once, and its layout shared by every report
+    template_layout = load_template(inputs['Template'], inputs['Cache Directory'])
+    if not template_layout:
+        return 1
 
-        # if the input is invalid then continue with the next input_path
-        if not all([ validator(df_raw) for validator in validators ]):
-            logging.error('Input report is invalid; report will be skipped.'.format(input_path))
-            continue
+    if arguments.watch:
+        from watcher import watch
+        return watch(inputs, config, reader, validators, cleaners, columns_to_merge, template_layout, rebuild = arguments.rebuild)
 
-        logging.info('\nCleaning data...')
-        df_clean = reduce(lambda df, cleaner: cleaner(df), cleaners, df_raw)
+    # reports whose input, template, icon and config are unchanged since they were built are skipped
+    manifest = Manifest.load(inputs['Outputs Directory'])
+    fingerprints = {}
 
-        output_filename = 'formatted_' + os.path.basename(input_path)
-        output_path = os.path.join(inputs['Outputs Directory'], output_filename)
-        wrapped_workbook = initialise_workbook(template_path = inputs['Template'],
-                                               output_path = output_path)
+    found_paths = list(get_input_paths(inputs['Inputs Directory']))
+    for input_path in found_paths:
+        fingerprints[input_path] = build_fingerprint(input_path, config)
 
-        order_id = extract_order_id(df_raw['Line Item'][0])
+    # in sheets mode every report is written to the same workbook, so either they are all skipped or none are
+    sheets = inputs['Output Mode'] == 'sheets'
+    rebuild = arguments.rebuild or (sheets and not all([ manifest.is_current(get_output_path(path, inputs['Outputs Directory']),
+                                                                             fingerprints[path]) for path in found_paths ]))
 
-        # if the intialisation has been cancelled by the user, go to next file
-        if not wrapped_workbook:
-            continue
+    # ask all the questions up front, so that the reports can then be formatted unattended
+    input_paths = []
+    for input_path in found_paths:
 
-        # each of these functions returns a WrappedWorkbook or None
-        transformations = [partial(write_data, df_clean),
-                           partial(apply_styling, image_path = inputs['Icon'], columns_to_merge = columns_to_merge),
-                           write_totals,
-                           partial(replace_order_id, order_id = order_id),
-                           remove_extra_tags,
-                           save_workbook]
+        logging.info('Found input "{}" '.format(input_path))
+        output_path = get_output_path(input_path, inputs['Outputs Directory'])
 
-        reduce(lambda wrapped_workbook, f: bind(wrapped_workbook, f), transformations, wrapped_workbook)
+        if not rebuild and manifest.is_current(output_path, fingerprints[input_path]):
+            logging.info('Nothing has changed since "{}" was formatted; skipping it.'.format(output_path))
+            continue
 
-        logging.info('Workbook formatting complete!\n')
-        log_divider(symbol = '*')
+        if not arguments.yes and not query_yes_no('Want to format this report?'):
+            logging.info('Okay, looking for other inputs...')
+            continue
 
-        pandas.set_option('display.float_format', lambda x: '%.3f' % x)
-        summary = [('Report Name', output_filename),
-                   ('Order ID', order_id),
-                   ('Total Ad server impressions', df_clean['Ad server impressions'].sum()),
-                   ('Total Ad server clicks', df_clean['Ad server clicks'].sum())]
+        # there's no need to ask before replacing an output that has not been touched since it was built
+        overwrite_policy = arguments.overwrite_policy
+        if overwrite_policy == 'ask' and manifest.is_built_output(output_path):
+            overwrite_policy = 'always'
+
+        if sheets or confirm_overwrite(output_path, overwrite_policy):
+            input_paths.append(input_path)
+
+    if sheets and input_paths:
+        output_path = get_sheets_output_path(inputs['Outputs Directory'])
+        overwrite_policy = arguments.overwrite_policy
+        if overwrite_policy == 'ask' and all([ manifest.is_built_output(get_output_path(path, inputs['Outputs Directory']))
+                                               for path in input_paths ]):
+            overwrite_policy = 'always'
+        if not confirm_overwrite(output_path, overwrite_policy):
+            input_paths = []
+
+    summaries = format_reports(input_paths,
+                               workers = inputs['Workers'],
+                               inputs = inputs,
+                               reader = reader,
+                               validators = validators,
+                               cleaners = cleaners,
+                               columns_to_merge = columns_to_merge,
+                               template_layout = template_layout)
+
+    # an input split into orders is recorded along with the report of each order
+    built_reports = defaultdict(list)
+    for summary in summaries:
+        summary = dict(summary)
+        built_reports[summary['Input Report']].append(os.path.join(inputs['Outputs Directory'], summary['Report Name']))
+    for input_path, output_paths in built_reports.items():
+        manifest.record(get_output_path(input_path, inputs['Outputs Directory']), fingerprints[input_path], output_paths)
+    if built_reports:
+        manifest.save()
 
-        summaries.append(summary)
+    log_divider(symbol = '*')
+    pandas.set_option('display.float_format', lambda x: '%.3f' % x)
 
     log_divider()
     logging.info('IMPORTANT: Below is a summary of the input report(s). ' +
@@ -464,13 +1010,13 @@ def main():
                  'during the cleansing process')
     log_divider()
     for summary in summaries:
-        for prop, value in summary:
-            logging.info('{:30s}: "{}"'.format(prop, value))
-        log_divider()
-        logging.info('')
+        log_summary(summary)
+
+    if not arguments.yes:
+        input('All inputs have been processed! Press ENTER to exit...')
+        print('')
 
-    input('All inputs have been processed! Press ENTER to exit...')
-    print('')
+    return 0
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
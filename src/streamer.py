@@ -0,0 +1,197 @@
+"""A write-only output engine that streams a formatted report straight to disk.
+
+The standard engine copies the template, loads it in full and keeps a Cell
+object for every value until the workbook is saved. This engine reads the
+template once (see layout.TemplateLayout) and writes each row of the report
+as it is produced with openpyxl's write-only mode, so memory use stays flat
+however many line items the report has.
+"""
+
+# Python stdlib imports
+from __future__ import unicode_literals
+from array import array
+import datetime
+import logging
+import numbers
+
+# package imports
+from exhelp import *
+from layout import *
+from reporter import *
+
+# openpyxl imports
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import is_date_format
+
+def is_date_value(value, number_format):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return True
+    return isinstance(value, numbers.Number) and is_date_format(number_format)
+
+def stream_report(df, layout, output_path, image_path, order_id, columns_to_merge = []):
+    """ Writes the formatted report for `df` to `output_path`, laid out and
+        styled as the template described by `layout`.
+
+        The output matches the standard write_data -> apply_styling ->
+        write_totals -> replace_order_id -> remove_extra_tags pipeline, except
+        that any template content below the data row is not carried over.
+
+        :param layout: the parsed template
+        :type layout: TemplateLayout
+
+        :return: the values saved alongside the subtotal and total formulas
+        :rtype: FormulaValues
+    """
+    return stream_rows(list(df.columns.values), report_rows(df), layout, output_path, image_path, order_id, columns_to_merge)
+
+def stream_rows(headers, rows, layout, output_path, image_path, order_id, columns_to_merge = []):
+    """ As stream_report, for the `rows` of the report body as report_rows
+        yields them, which may be produced as they are written.
+    """
+    logging.debug('Streaming report to "{}"...'.format(output_path))
+
+    if layout.rows_below_data:
+        logging.warning('Template "{}" has content below the data row; it is ignored in streaming mode.'.format(layout.path))
+
+    workbook = openpyxl.Workbook(write_only = True)
+    worksheet = workbook.create_sheet(title = layout.title)
+
+    data_start_row, data_start_column = layout.tag('<data_start>')
+    _, data_end_column = layout.tag('<data_end>')
+    header_row, header_column = layout.tag('<header_start>')
+    order_id_position = layout.tag('<order_id>')
+
+    # dimensions must be set before the first row is written
+    for letter, width in layout.column_widths.items():
+        worksheet.column_dimensions[letter].width = width
+    for index, height in layout.row_heights.items():
+        if index < data_start_row:
+            worksheet.row_dimensions[index].height = height
+
+    borders = BorderCache()
+    styles = StyleCache()
+    order_id_alignment = Alignment(horizontal = 'center', vertical = 'center', textRotation = 90)
+    bold_fonts = {}
+
+    def bold(font):
+        if id(font) not in bold_fonts:
+            bold_fonts[id(font)] = update_font(font, {'bold': True})
+        return bold_fonts[id(font)]
+
+    def order_id_cell(row, is_last_row):
+        is_first_row = row == order_id_position[0]
+        cell = WriteOnlyCell(worksheet, value = order_id if is_first_row else None)
+        if is_first_row and layout.order_id_style:
+            layout.order_id_style.apply(cell)
+            cell.font = bold(layout.order_id_style.font)
+        return styles.apply(cell, ('order_id', is_first_row, is_last_row),
+                            border = borders.get(True, True, is_first_row, is_last_row),
+                            alignment = order_id_alignment)
+
+    def append_row(cells):
+        worksheet.append([ cells.get(column) for column in range(1, max(cells) + 1 if cells else 1) ])
+
+    # write everything above the data block, filling in the headers and removing the tags
+    for index, template_row in enumerate(layout.rows_above_data):
+        row = index + 1
+        cells = dict((column, style.apply(WriteOnlyCell(worksheet, value = value)))
+                     for column, value, style in template_row)
+
+        if row == header_row:
+            for offset, header in enumerate(headers):
+                cells.setdefault(header_column + offset, WriteOnlyCell(worksheet)).value = header
+
+        for cell in cells.values():
+            if TagIndex.kind_of(cell.value) is not None:
+                cell.font = bold(cell.font)
+                cell.value = None
+
+        if order_id_position and order_id_position[0] == row:
+            cells[order_id_position[1]] = order_id_cell(row, False)
+
+        append_row(cells)
+
+    # then stream the body of the report, one row at a time
+    column_styles = layout.column_styles
+    column_count = data_end_column - data_start_column + 1
+    number_formats = None
+    total_bar_fill = PatternFill(patternType = 'solid', fgColor = 'F2F2F2')
+    no_fill = PatternFill()
+
+    merge_columns = [ data_start_column + headers.index(c) for c in columns_to_merge if c in headers ]
+    merged_groups = array('l')  # the first and last row of each merged group, in turn
+    merged_group = None
+
+    formula_values = FormulaValues(headers, data_start_row, data_start_column)
+    for offset, (values, group_size) in enumerate(formula_values.track(rows)):
+        row = data_start_row + offset
+        values = list(values) + [None] * (column_count - len(values))
+        kind = TagIndex.kind_of(values[0])
+        is_total_bar = values[0] == '<total_bar>'
+
+        # the first row decides which columns hold dates, as apply_styling does
+        if number_formats is None:
+            number_formats = [ 'dd/mm/yyyy' if is_date_value(value, style.number_format) else style.number_format
+                               for value, style in zip(values, column_styles) ]
+
+        # only the first row of a merged group keeps its value in the merged columns
+        if group_size > 1:
+            merged_group = (row, row + group_size - 1)
+            merged_groups.extend(merged_group)
+        in_merged_group = merged_group is not None and merged_group[0] < row <= merged_group[1]
+
+        cells = {}
+        for index in range(column_count):
+            column = data_start_column + index
+            style = column_styles[index]
+            value = values[index]
+
+            if is_total_bar:
+                value = None
+            elif kind == 'subtotal':
+                label = re.match(SubTotal.EXTRACTION_PATTERN, value).groupdict()
+                value = get_total_value(label['group_type'], column, row, row - int(label['group_size']), 'Total')
+            elif kind == 'total':
+                label = re.match(Total.EXTRACTION_PATTERN, value).groupdict()
+                value = get_total_value(label['group_type'], column, row, data_start_row, 'TOTAL')
+            elif in_merged_group and column in merge_columns:
+                value = None
+
+            # style the cell after giving it a value, as dates set a number format of their own
+            cell = styles.apply(WriteOnlyCell(worksheet, value = value), ('data', index, kind is not None, row == data_start_row, is_total_bar),
+                                font = bold(style.font) if kind is not None else style.font,
+                                alignment = style.alignment,
+                                number_format = number_formats[index],
+                                border = borders.get(index == 0, index == column_count - 1, row == data_start_row, is_total_bar),
+                                fill = total_bar_fill if is_total_bar else no_fill)
+            cells[column] = cell
+
+        if order_id_position and order_id_position[0] <= row:
+            cells[order_id_position[1]] = order_id_cell(row, is_total_bar)
+
+        append_row(cells)
+
+    # the merged ranges are only spelt out as they are written, as there are several for every group
+    def merged_ranges(last_row):
+        for merged_range in layout.merged_cells:
+            yield merged_range
+        for first, last in zip(merged_groups[::2], merged_groups[1::2]):
+            for column in merge_columns:
+                yield '{0}{1}:{0}{2}'.format(get_column_letter(column), first, last)
+
+        # the order id is merged down to the bottom of the data block
+        if order_id_position:
+            yield '{0}{1}:{0}{2}'.format(get_column_letter(order_id_position[1]), order_id_position[0], last_row)
+
+    # add the picture and limit the size
+    icon_position = layout.tag('<icon>')
+    if icon_position:
+        img = Image(image_path, coordinates = ((0,0), (1,1)), size = (80, 80))
+        img.drawing.anchortype = 'oneCell'
+        img.drawing.anchorrow, img.drawing.anchorcol = icon_position[0] - 1, icon_position[1] - 1
+        worksheet._images.append(img)
+
+    sheet_file = keep_sheet_on_disk(worksheet)
+    workbook.save(output_path)
+    add_merged_cells(output_path, merged_ranges(row), sheet_file = sheet_file, formula_values = formula_values.values)
+    return formula_values
@@ -0,0 +1,79 @@
+"""Synthetic DFP exports, laid out as the real ones, for benchmarking"""
+
+# Python stdlib imports
+from __future__ import division, unicode_literals
+
+# third party imports
+import numpy
+import pandas
+
+# package imports
+from config import DEFAULT_CONFIG
+
+CREATIVE_SIZES = ['300 x 250', '728 x 90', '160 x 600', '320 x 50', '1 x 1']
+NATIVE_FORMATS = ['Native Feed', 'Native Card', 'Native Video']
+DELIVERY_INDICATORS = ['On track', 'Behind', 'Ahead', 'Completed']
+
+def synthetic_export(rows, group_sizes = (1, 1, 1, 2, 3, 5), native_share = 0.2,
+                     test_rows = 0, total_row = True, seed = 0):
+    """ Returns a raw DFP export of `rows` line items, with the columns the
+        formatter requires.
+
+        :param group_sizes: the number of line items in each group (those that
+            share their dates and line item id) is drawn from these
+        :param native_share: the fraction of line items with a Native creative
+        :param test_rows: the number of extra line items named as TEST items
+        :param total_row: whether to end the export with DFP's 'Total' row
+
+        :rtype: pandas.DataFrame
+    """
+    random = numpy.random.RandomState(seed)
+
+    # enough groups to cover every row, then trimmed to size
+    sizes = random.choice(group_sizes, size = rows + test_rows)
+    group_ids = numpy.repeat(numpy.arange(len(sizes)), sizes)[:rows + test_rows]
+    count = len(group_ids)
+
+    start_dates = numpy.datetime64('2017-01-01') + random.randint(0, 60, size = len(sizes)).astype('timedelta64[D]')
+    start_dates = pandas.to_datetime(start_dates[group_ids])
+    end_dates = start_dates + pandas.to_timedelta(random.randint(7, 60, size = len(sizes))[group_ids], unit = 'D')
+
+    line_items = pandas.Series([ 'Campaign ORD-{}-{}-1-1 Display'.format(100000 + seed, group) for group in group_ids ])
+    if test_rows:
+        test_positions = random.choice(count, size = test_rows, replace = False)
+        line_items[test_positions] = line_items[test_positions] + ' TEST'
+
+    is_native = random.random_sample(count) < native_share
+    impressions = random.randint(0, 200000, size = count)
+    clicks = random.binomial(impressions, 0.002)
+
+    df = pandas.DataFrame({'Line Item': line_items,
+                           'Creative': [ 'Creative {}'.format(index) for index in range(count) ],
+                           'Delivery Indicator': random.choice(DELIVERY_INDICATORS, size = len(sizes))[group_ids],
+                           'Line item start date': start_dates,
+                           'Line item end date': end_dates,
+                           'Goal quantity': random.choice([500, 1000, 50000, 250000], size = len(sizes))[group_ids],
+                           'Creative Size': numpy.where(is_native, 'Native', random.choice(CREATIVE_SIZES, size = count)),
+                           'DAP Native Format': numpy.where(is_native, random.choice(NATIVE_FORMATS, size = count), '-'),
+                           'Ad server impressions': impressions,
+                           'Ad server clicks': clicks,
+                           'Ad server CTR': clicks / numpy.maximum(impressions, 1)},
+                          columns = DEFAULT_CONFIG['Required Columns'])
+
+    if total_row:
+        total = dict((column, None) for column in df.columns)
+        total.update({'Line Item': 'Total',
+                      'Ad server impressions': impressions.sum(),
+                      'Ad server clicks': clicks.sum(),
+                      'Ad server CTR': clicks.sum() / max(impressions.sum(), 1)})
+        df = pandas.concat([df, pandas.DataFrame([total], columns = df.columns)], ignore_index = True)
+
+    return df
+
+def write_export(df, path, sheet_name = DEFAULT_CONFIG['Sheet Name']):
+    """ Writes a synthetic export as the Excel or CSV file at `path` """
+    if path.lower().endswith('.csv'):
+        df.to_csv(path, index = False)
+    else:
+        df.to_excel(path, sheet_name = sheet_name, index = False)
+    return path
@@ -1,25 +1,72 @@
 from __future__ import unicode_literals
+import datetime
 import logging
+import numbers
 
 # there will be columns that we don't want and will drop, but ensure that
 # the columns we DO have are in the same order as in the data
 def validate_column_names(df, required_columns):
+    return validate_headers(list(df.columns.values), required_columns)
 
-    actual_columns = list(df.columns.values)
+def validate_headers(actual_columns, required_columns):
 
     logging.debug('Validating column names; expecting following in data: ')
     logging.debug('\t' + '\n\t'.join(required_columns))
 
-    # look for columns that we will ignore
+    # look for columns that we will ignore, or that are missing altogether
     ignored = [ column for column in actual_columns if column not in required_columns ]
     kept =    [ column for column in actual_columns if column in required_columns ]
+    missing = [ column for column in required_columns if column not in actual_columns ]
 
     for column in ignored:
         logging.debug('Ignoring column "{}".'.format(column))
 
+    for column in missing:
+        logging.warn('\tExpected "{0}", but there is no such column'.format(column))
+
     mismatches = [ (a, b) for a, b in zip(required_columns, kept) if a != b ]
 
     for column, header in mismatches:
         logging.warn('\tExpected "{0}", received "{1}"'.format(column, header))
 
-    return len(mismatches) == 0
+    return len(mismatches) == 0 and len(missing) == 0
+
+def is_number(value):
+    return isinstance(value, numbers.Number) and not isinstance(value, bool)
+
+def is_date(value):
+    # an end date may be 'Unlimited' (see cleaners.replace_datetime_with_date)
+    return isinstance(value, (datetime.date, datetime.datetime)) or value == 'Unlimited'
+
+# a helper class describing the columns an input report must have, in order,
+# and the kind of value each holds, so that a report can be checked from its
+# header row and first few rows before the whole of it is read
+class ReportSchema:
+
+    CHECKS = {'number': is_number, 'date': is_date}
+
+    def __init__(self, required_columns, column_types = None):
+        self.required_columns = required_columns
+        self.column_types = column_types or {}
+
+    def check_headers(self, headers):
+        """ Returns the positions of the required columns among `headers` (the
+            header row of a report), or None if any are missing or out of order.
+        """
+        if not validate_headers(headers, self.required_columns):
+            return None
+        return [ index for index, header in enumerate(headers) if header in self.required_columns ]
+
+    def check_values(self, sample):
+        """ Whether every value in the dataframe `sample` (the first rows of a
+            report) is of the kind its column should hold; blanks are allowed.
+        """
+        for column, kind in self.column_types.items():
+            check = ReportSchema.CHECKS.get(kind)
+            if check is None or column not in sample.columns:
+                continue
+            for index, value in sample[column].dropna().items():
+                if not check(value):
+                    logging.error('Column "{}" should hold {}s, but row {} holds "{}".'.format(column, kind, index + 2, value))
+                    return False
+        return True
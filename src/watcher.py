@@ -0,0 +1,276 @@
+"""Formats reports as they arrive, watching the inputs directory rather than
+walking it once.
+
+A run otherwise starts from nothing: the interpreter starts, pandas and
+openpyxl are imported and the template is parsed before the first report is
+read. Run with --watch, the formatter keeps all of that (and the worker
+processes that format the reports) between reports, and checks the inputs
+directory every 'Watch Interval' seconds. The directory is polled, which works
+the same on every platform and costs a listing of a few files.
+
+An input is only formatted once it has settled: its size and modification time
+are unchanged since the last check, it was last modified at least
+'Settle Seconds' ago, and Excel holds no lock file (~$...) for it. It is
+formatted again whenever it changes (once it has finished being formatted, if
+it changes meanwhile), unless the manifest shows that its output is already
+current. A template edited while watching is parsed again before
+any more reports are started.
+
+The reports waiting and being formatted, and the latency of the last few, are
+written to .status.json in the outputs directory at every check.
+"""
+
+# Python stdlib imports
+from __future__ import unicode_literals
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+import datetime
+import json
+import logging
+import os
+import signal
+import time
+
+# package imports
+from reporter import *
+
+# the number of finished reports kept in the status file
+RECENT_REPORTS = 20
+
+def input_signature(path):
+    """ Returns the size and modification time of a file, or None if it has gone """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_size, stat.st_mtime)
+
+def is_locked(path, filenames):
+    """ Whether Excel holds a lock file for `path` among `filenames` (those in
+        its directory). Excel names it '~$' followed by the filename, less its
+        first characters if the name is long.
+    """
+    filename = os.path.basename(path)
+    return any([ name[:2] == '~$' and len(name) > 2 and filename.endswith(name[2:]) for name in filenames ])
+
+def ignore_interrupts():
+    """ Sets a worker process to ignore Ctrl+C, which reaches every process
+        attached to the console (and SIGTERM, which a service manager may send
+        to every process of the service), so that the watcher alone decides
+        when to stop
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+def interrupt(signum, frame):
+    """ Stops the watcher on SIGTERM as Ctrl+C does """
+    raise KeyboardInterrupt
+
+def timestamp():
+    return datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+# a helper class that debounces the inputs directory: an input is ready once it
+# has settled, and is ready again only once it has changed
+class InputQueue:
+
+    def __init__(self, inputs_directory, settle_seconds):
+        self.inputs_directory = inputs_directory
+        self.settle_seconds = settle_seconds
+        self.settling = {}    # the signature of each input not yet settled, and when it was first seen
+        self.handled = {}     # the signature of each input when it was last made ready
+        self.ready = deque()  # (input path, when it was first seen)
+
+    def __len__(self):
+        return len(self.settling) + len(self.ready)
+
+    def poll(self, now = None):
+        """ Checks the inputs directory, making ready any input that has settled """
+        now = now if now is not None else time.time()
+        filenames = os.listdir(self.inputs_directory)
+        input_paths = list(get_input_paths(self.inputs_directory))
+
+        # forget the inputs that have gone, so that they are formatted if they come back
+        for path in [ path for path in list(self.settling) + list(self.handled) if path not in input_paths ]:
+            self.settling.pop(path, None)
+            self.handled.pop(path, None)
+
+        for path in input_paths:
+            signature = input_signature(path)
+            if signature is None or self.handled.get(path) == signature:
+                continue
+
+            previous = self.settling.get(path)
+            if previous is None or previous[0] != signature:
+                self.settling[path] = (signature, previous[1] if previous else now)
+                continue
+            if now - signature[1] < self.settle_seconds or is_locked(path, filenames):
+                continue
+
+            # an input that changes while it waits is formatted once, as it is when its turn comes
+            del self.settling[path]
+            self.handled[path] = signature
+            if path not in [ ready_path for ready_path, _ in self.ready ]:
+                self.ready.append((path, previous[1]))
+
+# a helper class that keeps the status file up to date
+class WatchStatus:
+
+    FILENAME = '.status.json'
+
+    def __init__(self, outputs_directory):
+        self.path = os.path.join(outputs_directory, WatchStatus.FILENAME)
+        self.started = timestamp()
+        self.counts = OrderedDict([('formatted', 0), ('skipped', 0), ('failed', 0)])
+        self.recent = deque(maxlen = RECENT_REPORTS)
+
+    def record(self, input_path, result, first_seen, started = None, output_paths = None):
+        """ Records a finished input; `first_seen` and `started` are the times it was found and dispatched """
+        finished = time.time()
+        self.counts[result] += 1
+        self.recent.appendleft(OrderedDict([('input', input_path),
+                                            ('result', result),
+                                            ('outputs', output_paths or []),
+                                            ('finished', timestamp()),
+                                            ('latency_seconds', round(finished - first_seen, 3)),
+                                            ('format_seconds', round(finished - started, 3) if started else None)]))
+
+    def save(self, state, queue, running):
+        """ :param queue: the inputs waiting to be formatted
+            :param running: the paths of the inputs being formatted
+        """
+        status = OrderedDict([('state', state),
+                              ('started', self.started),
+                              ('updated', timestamp()),
+                              ('queue_depth', len(queue) + len(running)),
+                              ('settling', sorted(queue.settling)),
+                              ('queued', [ path for path, _ in queue.ready ]),
+                              ('running', sorted(running)),
+                              ('counts', self.counts),
+                              ('recent', list(self.recent))])
+
+        with open(self.path + '.tmp', 'w') as status_file:
+            json.dump(status, status_file, indent = 2)
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+        os.rename(self.path + '.tmp', self.path)
+
+def watch(inputs, config, reader, validators, cleaners, columns_to_merge, template_layout, rebuild = False):
+    """ Formats each input as it arrives in (or changes within) the inputs
+        directory, as reporter.format_report does, until interrupted (by Ctrl+C,
+        or by SIGTERM, e.g. from a service manager).
+
+        :param config: the settings the manifest fingerprints each report with
+        :param rebuild: format every input, even those whose output is current
+
+        :return: the exit code
+    """
+    if inputs['Output Mode'] == 'sheets':
+        logging.error('Sheets mode writes every report to one workbook, so it cannot watch for inputs.')
+        return 1
+
+    # orders are written across a pool of their own (see format_orders), so split inputs are formatted in turn
+    workers = inputs['Workers']
+    if workers > 1 and not inputs['Split Orders']:
+        executor = ProcessPoolExecutor(max_workers = workers, initializer = ignore_interrupts)
+    else:
+        workers, executor = 1, ThreadPoolExecutor(max_workers = 1)
+
+    outputs_directory = inputs['Outputs Directory']
+    manifest = Manifest.load(outputs_directory)
+    queue = InputQueue(inputs['Inputs Directory'], inputs['Settle Seconds'])
+    status = WatchStatus(outputs_directory)
+    template_signature = input_signature(inputs['Template'])
+    running = {}  # the input path, fingerprint, and times found and dispatched of each report being formatted
+
+    def dispatch(input_path, first_seen):
+        if not os.path.isfile(input_path):
+            return
+        output_path = get_output_path(input_path, outputs_directory)
+        fingerprint = build_fingerprint(input_path, config)
+
+        if not rebuild and manifest.is_current(output_path, fingerprint):
+            logging.info('Nothing has changed since "{}" was formatted; skipping it.'.format(output_path))
+            status.record(input_path, 'skipped', first_seen)
+            return
+        if not confirm_overwrite(output_path, inputs['Overwrite']):
+            status.record(input_path, 'skipped', first_seen)
+            return
+
+        logging.info('Formatting "{}"...'.format(input_path))
+        future = executor.submit(format_report, input_path, inputs = inputs,
+                                                            reader = reader,
+                                                            validators = validators,
+                                                            cleaners = cleaners,
+                                                            columns_to_merge = columns_to_merge,
+                                                            template_layout = template_layout)
+        running[future] = (input_path, fingerprint, first_seen, time.time())
+
+    def finish(future):
+        input_path, fingerprint, first_seen, started = running.pop(future)
+        try:
+            summaries = future.result()
+        except Exception:
+            logging.exception('Formatting "{}" failed; report will be skipped.'.format(input_path))
+            summaries = []
+
+        # an input split into orders is recorded along with the report of each order
+        output_paths = [ os.path.join(outputs_directory, dict(summary)['Report Name']) for summary in summaries ]
+        if summaries:
+            manifest.record(get_output_path(input_path, outputs_directory), fingerprint, output_paths)
+            manifest.save()
+        for summary in summaries:
+            log_summary(summary)
+
+        status.record(input_path, 'formatted' if summaries else 'failed', first_seen, started, output_paths)
+        logging.info('{} "{}" in {:.3f}s; {} input(s) waiting.'.format('Formatted' if summaries else 'Could not format',
+                                                                       input_path, time.time() - first_seen, len(queue)))
+
+    logging.info('Watching "{}" for inputs every {}s, across {} worker(s); press Ctrl+C to stop.'.format(
+        inputs['Inputs Directory'], inputs['Watch Interval'], workers))
+
+    previous_handler = signal.signal(signal.SIGTERM, interrupt)
+    try:
+        while True:
+            signature = input_signature(inputs['Template'])
+            if signature != template_signature:
+                template_signature = signature
+                logging.info('Template "{}" has changed; parsing it again...'.format(inputs['Template']))
+                template_layout = load_template(inputs['Template'], inputs['Cache Directory'])
+
+            # no reports are started while the template is unusable, until it is fixed
+            queue.poll()
+            deferred = []
+            while template_layout and queue.ready and len(running) < workers:
+                input_path, first_seen = queue.ready.popleft()
+                # an input that changed while it was being formatted waits for that to finish
+                if input_path in [ path for path, _, _, _ in running.values() ]:
+                    deferred.append((input_path, first_seen))
+                else:
+                    dispatch(input_path, first_seen)
+            queue.ready.extendleft(reversed(deferred))
+
+            status.save('watching', queue, [ path for path, _, _, _ in running.values() ])
+
+            # a report that finishes is noticed at once, rather than at the next check
+            if running:
+                done, _ = wait(list(running), timeout = inputs['Watch Interval'], return_when = FIRST_COMPLETED)
+                for future in done:
+                    finish(future)
+            else:
+                time.sleep(inputs['Watch Interval'])
+
+    except KeyboardInterrupt:
+        logging.info('Stopping; waiting for the reports being formatted to finish...')
+
+    finally:
+        signal.signal(signal.SIGTERM, previous_handler)
+
+        # the reports not yet started are left for the next run
+        for future in [ future for future in running if future.cancel() ]:
+            running.pop(future)
+        executor.shutdown(wait = True)
+        for future in list(running):
+            finish(future)
+        status.save('stopped', queue, [])
+
+    return 0
@@ -0,0 +1,22 @@
+from __future__ import unicode_literals
+
+from config import build_cleaners, load_config
+from plan import CleanerPlan
+from readers import convert_dates
+from reporter import get_group_ids
+from synthetic import synthetic_export
+
+def test_group_ids_with_unlimited_in_one_chunk():
+    config = load_config()
+    export = synthetic_export(40, group_sizes = (2,), total_row = False)
+    export['Line item end date'] = export['Line item end date'].astype(object)
+    export.loc[30, 'Line item end date'] = 'Unlimited'
+    plan = CleanerPlan(build_cleaners(config))
+
+    # the dates are parsed for each chunk as read_report_chunks parses them
+    whole, _ = plan.execute(convert_dates(export.copy(), config['Date Columns']))
+    chunks = [ plan.execute(convert_dates(chunk.copy(), config['Date Columns']), strict_filters = True)[0]
+               for chunk in [export[:20], export[20:]] ]
+
+    # each line item has the same group in whichever chunk it is cleaned
+    assert list(get_group_ids(chunks[0])) + list(get_group_ids(chunks[1])) == list(get_group_ids(whole))
@@ -0,0 +1,50 @@
+from __future__ import unicode_literals
+from copy import copy
+
+import openpyxl
+from openpyxl.styles import Alignment, Border, Font, PatternFill, Side
+
+from exhelp import load_workbook, workbook_from_template
+
+def save_template(path):
+    workbook = openpyxl.Workbook()
+    worksheet = workbook.active
+    worksheet.title = 'Report'
+    worksheet['A1'] = '<icon>'
+    worksheet['B2'] = 'Campaign report'
+    worksheet['B2'].font = Font(name = 'Arial', size = 18, bold = True, color = 'FF336699')
+    worksheet['B2'].alignment = Alignment(horizontal = 'center')
+    worksheet.merge_cells('B2:E3')
+    worksheet['B5'] = '<header_start>'
+    worksheet['B5'].fill = PatternFill(fill_type = 'solid', start_color = 'FFDDEEFF', end_color = 'FFDDEEFF')
+    worksheet['B5'].border = Border(bottom = Side(style = 'thin'))
+    worksheet['C6'] = 0.25
+    worksheet['C6'].number_format = '0.00%'
+    worksheet.column_dimensions['B'].width = 42
+    worksheet.row_dimensions[2].height = 30
+    workbook.save(path)
+    return path
+
+def cell_styles(worksheet):
+    # a cell's styles are proxies, which only compare equal once copied
+    return dict((cell.coordinate, (cell.value, copy(cell.font), copy(cell.fill), copy(cell.border), copy(cell.alignment),
+                                   cell.number_format))
+                for row in worksheet.iter_rows() for cell in row)
+
+def test_workbook_from_template_matches_the_template(tmpdir):
+    path = save_template(str(tmpdir.join('template.xlsx')))
+    template = load_workbook(path).active
+
+    copied = workbook_from_template(template).active
+    assert copied.title == template.title
+    assert cell_styles(copied) == cell_styles(template)
+    assert sorted(copied.merged_cells) == sorted(template.merged_cells)
+    assert copied.column_dimensions['B'].width == template.column_dimensions['B'].width
+    assert copied.row_dimensions[2].height == template.row_dimensions[2].height
+
+    # and as saved, it reads back as the template does
+    copied.parent.save(str(tmpdir.join('copy.xlsx')))
+    saved = load_workbook(str(tmpdir.join('copy.xlsx'))).active
+    fresh = load_workbook(path).active
+    assert cell_styles(saved) == cell_styles(fresh)
+    assert sorted(saved.merged_cells) == sorted(fresh.merged_cells)
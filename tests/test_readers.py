@@ -0,0 +1,19 @@
+from __future__ import unicode_literals
+import datetime
+
+from config import build_reader, load_config
+from synthetic import synthetic_export, write_export
+
+def test_csv_with_unlimited_end_date(tmpdir):
+    config = load_config()
+    export = synthetic_export(20, total_row = False)
+    export['Line item end date'] = export['Line item end date'].astype(object)
+    export.loc[3, 'Line item end date'] = 'Unlimited'
+    input_path = write_export(export, str(tmpdir.join('report.csv')))
+
+    df = build_reader(config)(input_path)
+
+    assert df is not None
+    end_dates = df['Line item end date']
+    assert end_dates[3] == 'Unlimited'
+    assert all([ isinstance(value, datetime.datetime) for value in end_dates.drop(3) ])